@@ -0,0 +1,376 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+CHUNK_SIZE = 64 * 1024
+
+PACKAGE_CACHE_ROOT = getattr(settings, 'ADVERTS_PACKAGE_CACHE_ROOT',
+                             os.path.join(tempfile.gettempdir(), 'adverts_v2_packages'))
+PACKAGE_CACHE_MAX_SIZE = getattr(settings, 'ADVERTS_PACKAGE_CACHE_MAX_SIZE', 2 * 1024 ** 3)
+
+
+class ZipStreamBuffer(io.RawIOBase):
+    """
+    Несжимаемый поток для zipfile: всё записанное копится до ближайшего pop().
+    Позиционирования нет, поэтому zipfile пишет записи с data descriptor и не возвращается назад.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def read_chunks(source, chunk_size=CHUNK_SIZE):
+    if isinstance(source, bytes):
+        yield source
+        return
+
+    source.open('rb')
+    try:
+        yield from source.chunks(chunk_size)
+    finally:
+        source.close()
+
+
+def iter_zip(entries, chunk_size=CHUNK_SIZE):
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, source in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, 'w') as entry:
+                for chunk in read_chunks(source, chunk_size):
+                    entry.write(chunk)
+                    data = buffer.pop()
+                    if data:
+                        yield data
+            data = buffer.pop()
+            if data:
+                yield data
+    yield buffer.pop()
+
+
+def prepare_photo(source, max_size=None, crop=False, quality=None):
+    """
+    Читает фото (путь или байты), при необходимости уменьшает или обрезает его и пережимает в JPEG.
+    Функция модульного уровня, чтобы её можно было отдавать и в пул процессов.
+    """
+    if max_size is None and quality is None:
+        if isinstance(source, bytes):
+            return source
+        with open(source, 'rb') as photo_file:
+            return photo_file.read()
+
+    image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max_size is not None:
+        if crop:
+            image = ImageOps.fit(image, max_size, Image.ANTIALIAS)
+        else:
+            image.thumbnail(max_size, Image.ANTIALIAS)
+
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=quality or 90, optimize=True)
+    return output.getvalue()
+
+
+class StreamingArchiveBuilder:
+    """
+    Базовый сборщик архива, который отдаёт записи по одной, без временного файла.
+    Подклассы из options.ARCHIVE_BUILDERS_MODULE переопределяют состав и имена записей.
+    Фото и тексты готовятся в пуле executor_class (при max_workers=0 прямо в потоке запроса),
+    а в архив попадают в исходном порядке.
+    """
+    text_file_name = 'advert.txt'
+
+    executor_class = ThreadPoolExecutor
+    max_workers = os.cpu_count() or 1
+
+    photo_max_size = None
+    photo_crop = False
+    photo_quality = None
+
+    use_package_cache = True
+
+    def __init__(self, adverts):
+        self.adverts = adverts
+
+    def __getstate__(self):
+        # для пула процессов: выборку объявлений в воркеры не передаём
+        state = self.__dict__.copy()
+        state.pop('adverts', None)
+        return state
+
+    def get_executor(self):
+        return self.executor_class(max_workers=self.max_workers)
+
+    def get_max_pending(self):
+        return self.max_workers * 2
+
+    def get_archive_name(self):
+        return 'adverts-{0}.zip'.format(timezone.now().strftime('%Y%m%d-%H%M%S'))
+
+    def get_advert_directory(self, advert):
+        return str(advert.id)
+
+    def render_advert_text(self, advert):
+        return '{0}\n\n{1}\n'.format(advert.title, advert.description)
+
+    def build_advert_text(self, advert):
+        return self.render_advert_text(advert).encode('utf-8')
+
+    def get_advert_photos(self, advert):
+        return sorted(advert.enabled_photos, key=lambda photo: not photo.is_main)
+
+    def is_photo_recompressed(self):
+        return self.photo_max_size is not None or self.photo_quality is not None
+
+    def get_photo_name(self, advert, photo, index):
+        if self.is_photo_recompressed():
+            extension = '.jpg'
+        else:
+            extension = os.path.splitext(photo.image.name)[1].lower() or '.jpg'
+        return '{0}/{1}{2}'.format(self.get_advert_directory(advert), index, extension)
+
+    def get_photo_source(self, photo):
+        try:
+            return photo.image.path
+        except NotImplementedError:
+            return b''.join(read_chunks(photo.image))
+
+    def get_advert_tasks(self, advert):
+        text_name = '{0}/{1}'.format(self.get_advert_directory(advert), self.text_file_name)
+        yield text_name, self.build_advert_text, (advert, )
+        for index, photo in enumerate(self.get_advert_photos(advert), start=1):
+            yield self.get_photo_name(advert, photo, index), prepare_photo, (
+                self.get_photo_source(photo), self.photo_max_size, self.photo_crop, self.photo_quality)
+
+    def get_cache_signature(self):
+        return '{0}.{1}:{2}:{3}:{4}:{5}'.format(type(self).__module__, type(self).__qualname__, self.text_file_name,
+                                               self.photo_max_size, self.photo_crop, self.photo_quality)
+
+    def iter_tasks(self, adverts):
+        for advert in adverts:
+            for name, func, args in self.get_advert_tasks(advert):
+                yield advert, name, func, args
+
+    def iter_results(self, adverts):
+        if not self.max_workers:
+            for advert, name, func, args in self.iter_tasks(adverts):
+                yield advert, name, func(*args)
+            return
+
+        pending = deque()
+        with self.get_executor() as executor:
+            for advert, name, func, args in self.iter_tasks(adverts):
+                pending.append((advert, name, executor.submit(func, *args)))
+                if len(pending) >= self.get_max_pending():
+                    advert, name, future = pending.popleft()
+                    yield advert, name, future.result()
+
+            while pending:
+                advert, name, future = pending.popleft()
+                yield advert, name, future.result()
+
+    def iter_advert_entries(self, adverts):
+        for advert, results in groupby(self.iter_results(adverts), key=itemgetter(0)):
+            yield advert, [(name, data) for _, name, data in results]
+
+    def iter_entries(self):
+        for advert, name, data in self.iter_results(self.adverts):
+            yield name, data
+
+    def stream(self):
+        if self.use_package_cache:
+            return package_cache.stream(self)
+        return iter_zip(self.iter_entries())
+
+
+class PackageCache:
+    """
+    Кеш собранных архивов на локальном диске с адресацией по содержимому.
+    Ключ архива строится из сборщика и ключей объявлений (id, updated, контрольные суммы включённых фото),
+    поэтому после правки пересобираются только изменённые объявления: их фрагменты хранятся отдельно.
+    При превышении max_size удаляются давно не использованные файлы.
+    """
+    stats_key = 'adverts_v2:package_cache:{0}'
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self._evict_lock = threading.Lock()
+
+    def count(self, name):
+        key = self.stats_key.format(name)
+        cache.add(key, 0, timeout=None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            pass
+
+    def get_stats(self):
+        names = ('package_hits', 'package_misses', 'fragment_hits', 'fragment_misses')
+        values = cache.get_many([self.stats_key.format(name) for name in names])
+        return {name: values.get(self.stats_key.format(name), 0) for name in names}
+
+    @staticmethod
+    def digest(*parts):
+        return hashlib.sha1('\n'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    def get_advert_digest(self, builder, advert):
+        photos = ['{0}:{1}'.format(photo.checksum, int(photo.is_main)) for photo in builder.get_advert_photos(advert)]
+        return self.digest(builder.get_cache_signature(), advert.id, advert.updated.isoformat(), *photos)
+
+    def get_path(self, kind, digest):
+        return os.path.join(self.root, kind, digest[:2], '{0}.zip'.format(digest))
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def write_atomic(self, path, chunks):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '{0}.{1}.tmp'.format(path, uuid.uuid4().hex)
+        complete = False
+        try:
+            with open(temp_path, 'wb') as temp_file:
+                for chunk in chunks:
+                    temp_file.write(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            if complete:
+                os.replace(temp_path, path)
+            else:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    def load_fragment(self, digest):
+        path = self.get_path('fragments', digest)
+        try:
+            with zipfile.ZipFile(path) as fragment:
+                entries = [(name, fragment.read(name)) for name in fragment.namelist()]
+        except (OSError, zipfile.BadZipfile):
+            return None
+        self.touch(path)
+        return entries
+
+    def store_fragment(self, digest, entries):
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as fragment:
+            for name, data in entries:
+                fragment.writestr(name, data)
+        for _ in self.write_atomic(self.get_path('fragments', digest), [output.getvalue()]):
+            pass
+
+    def iter_entries(self, builder, adverts, digests):
+        fragments = {}
+        for advert, digest in zip(adverts, digests):
+            if os.path.exists(self.get_path('fragments', digest)):
+                fragments[advert.id] = digest
+
+        built = builder.iter_advert_entries([advert for advert in adverts if advert.id not in fragments])
+        for advert, digest in zip(adverts, digests):
+            entries = self.load_fragment(digest) if advert.id in fragments else None
+            if entries is not None:
+                self.count('fragment_hits')
+            else:
+                self.count('fragment_misses')
+                if advert.id in fragments:
+                    # фрагмент успели вытеснить между проверкой и чтением
+                    _, entries = next(builder.iter_advert_entries([advert]))
+                else:
+                    _, entries = next(built)
+                self.store_fragment(digest, entries)
+            yield from entries
+
+    def stream(self, builder):
+        adverts = list(builder.adverts)
+        digests = [self.get_advert_digest(builder, advert) for advert in adverts]
+        path = self.get_path('packages', self.digest(builder.get_cache_signature(), *digests))
+
+        try:
+            package_file = open(path, 'rb')
+        except OSError:
+            package_file = None
+
+        if package_file is not None:
+            self.count('package_hits')
+            self.touch(path)
+            with package_file:
+                yield from iter(lambda: package_file.read(CHUNK_SIZE), b'')
+            return
+
+        self.count('package_misses')
+        yield from self.write_atomic(path, iter_zip(self.iter_entries(builder, adverts, digests)))
+        self.evict()
+
+    def evict(self):
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            files = []
+            for directory, _, names in os.walk(self.root):
+                for name in names:
+                    if name.endswith('.tmp'):
+                        continue
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+
+            total_size = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total_size -= size
+        finally:
+            self._evict_lock.release()
+
+
+package_cache = PackageCache(PACKAGE_CACHE_ROOT, PACKAGE_CACHE_MAX_SIZE)
@@ -0,0 +1,69 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+VERSION_CHECK_INTERVAL = getattr(settings, 'ADVERTS_LOCAL_CACHE_CHECK_INTERVAL', 2)
+
+
+class VersionedLocalCache:
+    """
+    Кеш в памяти процесса. Номер версии хранится в общем кеше Django,
+    поэтому сброс в одном процессе доходит до всех остальных.
+    Нужен общий для процессов бэкенд (memcached, redis): с LocMemCache каждый процесс видит только свои сбросы.
+    Версия сверяется не чаще раза в VERSION_CHECK_INTERVAL секунд, чужой сброс доходит с такой задержкой.
+    """
+
+    def __init__(self, name, check_interval=VERSION_CHECK_INTERVAL):
+        self.version_key = 'adverts_v2:{0}:version'.format(name)
+        self.check_interval = check_interval
+        self._data = {}
+        self._version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def get_version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, int(time.time() * 1000), timeout=None)
+            version = cache.get(self.version_key)
+        return version
+
+    def is_checked(self):
+        return self._checked_at is not None and time.monotonic() - self._checked_at < self.check_interval
+
+    def get(self, key, build):
+        with self._lock:
+            checked = self.is_checked()
+            if checked and key in self._data:
+                return self._data[key]
+            version = self._version
+
+        if not checked:
+            version = self.get_version()
+        with self._lock:
+            if version != self._version:
+                self._data = {}
+                self._version = version
+            if not checked:
+                self._checked_at = time.monotonic()
+            if key in self._data:
+                return self._data[key]
+
+        value = build()
+        with self._lock:
+            if self._version == version:
+                self._data[key] = value
+        return value
+
+    def invalidate(self):
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.add(self.version_key, int(time.time() * 1000), timeout=None)
+
+        with self._lock:
+            self._data = {}
+            self._version = None
+            self._checked_at = None
@@ -0,0 +1,86 @@
+import hashlib
+import random
+import re
+
+from django.conf import settings
+
+MINHASH_PERMUTATIONS = getattr(settings, 'ADVERTS_MINHASH_PERMUTATIONS', 128)
+MINHASH_BANDS = getattr(settings, 'ADVERTS_MINHASH_BANDS', 16)
+SHINGLE_SIZE = getattr(settings, 'ADVERTS_SHINGLE_SIZE', 5)
+DUPLICATE_SIMILARITY = getattr(settings, 'ADVERTS_DUPLICATE_SIMILARITY', 0.8)
+# из корзины LSH берутся только самые старые объявления, в больших корзинах сравнение идёт с представителями
+DUPLICATE_BUCKET_LIMIT = getattr(settings, 'ADVERTS_DUPLICATE_BUCKET_LIMIT', 1000)
+DUPLICATE_BUCKET_LEADERS = getattr(settings, 'ADVERTS_DUPLICATE_BUCKET_LEADERS', 50)
+
+MERSENNE_PRIME = (1 << 61) - 1
+WORDS_RE = re.compile(r'\w+')
+
+# коэффициенты хеш-функций фиксированы: сигнатуры в базе должны оставаться сравнимыми
+_random = random.Random(MINHASH_PERMUTATIONS)
+PERMUTATIONS = [(_random.randrange(1, MERSENNE_PRIME), _random.randrange(0, MERSENNE_PRIME))
+                for _ in range(MINHASH_PERMUTATIONS)]
+
+
+def hash64(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def get_shingles(*texts, size=SHINGLE_SIZE):
+    """Символьные шинглы нормализованного текста: регистр, пунктуация и пробелы не влияют."""
+    text = ' '.join(' '.join(WORDS_RE.findall(text.lower())) for text in texts if text)
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[index:index + size] for index in range(len(text) - size + 1)}
+
+
+def get_signature(shingles):
+    hashes = [hash64(shingle) % MERSENNE_PRIME for shingle in shingles]
+    if not hashes:
+        return None
+    return [min((a * value + b) % MERSENNE_PRIME for value in hashes) for a, b in PERMUTATIONS]
+
+
+def get_text_signature(*texts):
+    # отдельная функция уровня модуля: её можно отправить в процесс-воркер
+    return get_signature(get_shingles(*texts))
+
+
+def get_bands(signature, bands=MINHASH_BANDS):
+    """
+    Ключи LSH: сигнатура режется на полосы, каждая полоса хешируется целиком.
+    Тексты со сходством выше ~(1 / bands) ** (1 / rows) почти наверняка совпадут хотя бы в одной полосе.
+    """
+    rows = len(signature) // bands
+    return ['{0}:{1:x}'.format(band, hash64(','.join(map(str, signature[band * rows:(band + 1) * rows]))))
+            for band in range(bands)]
+
+
+def get_similarity(first, second):
+    return sum(a == b for a, b in zip(first, second)) / len(first)
+
+
+class UnionFind:
+    def __init__(self):
+        self.parents = {}
+
+    def find(self, item):
+        root = self.parents.setdefault(item, item)
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while item != root:
+            # сначала переставляем указатель узла, потом идём к бывшему родителю
+            self.parents[item], item = root, self.parents[item]
+        return root
+
+    def union(self, first, second):
+        first, second = self.find(first), self.find(second)
+        if first != second:
+            # корень кластера - самое старое объявление
+            first, second = sorted((first, second))
+            self.parents[second] = first
+
+    def groups(self):
+        result = {}
+        for item in self.parents:
+            result.setdefault(self.find(item), []).append(item)
+        return result
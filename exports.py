@@ -0,0 +1,90 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from apps.adverts_extras.models import City, District, Metro, Street
+from . import options
+from .geo import geo_references
+
+GEO_FIELDS = {'city': City, 'district': District, 'metro': Metro, 'street': Street}
+EXCLUDED_FIELDS = ('search_vector', 'address_normalized')
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+
+class EchoBuffer:
+    # csv.writer пишет строку сюда, а мы сразу отдаём её наружу
+    def write(self, value):
+        return value
+
+
+class AdvertExporter:
+    """
+    Потоковая выгрузка объявлений категории в CSV или JSONL.
+    Строки читаются серверным курсором (iterator()), поэтому память не растёт с размером категории.
+    Поля подкласса категории выгружаются вместе с полями объявления, вместо id справочников - названия.
+    """
+
+    def __init__(self, category, statuses=None):
+        self.category = category
+        self.model = category.get_model()
+        self.statuses = statuses
+
+    def get_fields(self):
+        return [field for field in self.model._meta.concrete_fields
+                if not (field.primary_key and field.name != 'id') and field.name not in EXCLUDED_FIELDS]
+
+    def get_columns(self):
+        columns = []
+        for field in self.get_fields():
+            columns.append(field.name if field.name not in GEO_FIELDS else field.attname)
+            if field.name in GEO_FIELDS:
+                columns.append(field.name)
+        return columns
+
+    def get_queryset(self):
+        queryset = self.model._base_manager.filter(category=self.category)
+        if self.statuses:
+            queryset = queryset.filter(status__in=self.statuses)
+        return queryset.order_by('id')
+
+    def iter_rows(self):
+        fields = self.get_fields()
+        attnames = [field.attname for field in fields]
+        statuses = dict(options.ADVERT_STATUSES)
+        # справочники берём один раз на выгрузку, а не по обращению к кешу на каждую строку
+        geo_titles = {name: geo_references.get_titles(model) for name, model in GEO_FIELDS.items()}
+        for values in self.get_queryset().values_list(*attnames).iterator():
+            row = {}
+            for field, value in zip(fields, values):
+                if field.name in GEO_FIELDS:
+                    row[field.attname] = value
+                    row[field.name] = geo_titles[field.name].get(value)
+                elif field.name == 'status':
+                    row[field.name] = statuses.get(value, value)
+                else:
+                    row[field.name] = value
+            yield row
+
+    def iter_csv(self):
+        columns = self.get_columns()
+        writer = csv.DictWriter(EchoBuffer(), fieldnames=columns)
+        yield writer.writerow(dict(zip(columns, columns)))
+        for row in self.iter_rows():
+            yield writer.writerow(row)
+
+    def iter_jsonl(self):
+        for row in self.iter_rows():
+            yield json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+    def stream(self, export_format):
+        if export_format not in CONTENT_TYPES:
+            raise ValueError('Unknown export format {}'.format(export_format))
+        return getattr(self, 'iter_{}'.format(export_format))()
+
+    def get_file_name(self, export_format):
+        return '{0}-{1}.{2}'.format(self.category.alias, timezone.now().strftime('%Y%m%d-%H%M'), export_format)
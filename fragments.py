@@ -0,0 +1,80 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+
+from apps.adverts_extras.models import City, District, Metro, Street
+from . import options
+from .instrumentation import render_to_string
+
+FRAGMENT_TEMPLATE = 'adverts_v2/advert-in-list.html'
+FRAGMENT_CACHE_TIMEOUT = getattr(settings, 'ADVERTS_FRAGMENT_CACHE_TIMEOUT', 24 * 60 * 60)
+REFERENCES_VERSION_KEY = 'adverts_v2:advert-row:references-version'
+
+
+def get_photos_version_key(advert_id):
+    return 'adverts_v2:advert:{0}:photos-version'.format(advert_id)
+
+
+def get_photos_versions(advert_ids):
+    keys = {advert_id: get_photos_version_key(advert_id) for advert_id in advert_ids}
+    versions = cache.get_many(keys.values())
+    return {advert_id: versions.get(key, 0) for advert_id, key in keys.items()}
+
+
+def bump_photos_version(advert_id):
+    key = get_photos_version_key(advert_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def bump_references_version(sender=None, **kwargs):
+    # строка показывает название категории и адрес: их изменение сбрасывает все строки
+    try:
+        cache.incr(REFERENCES_VERSION_KEY)
+    except ValueError:
+        if not cache.add(REFERENCES_VERSION_KEY, 1, timeout=None):
+            cache.incr(REFERENCES_VERSION_KEY)
+
+
+def get_fragment_key(advert, status, photos_version, references_version, today):
+    # status - статус списка, в котором выводится строка, advert.status меняется и без обновления updated.
+    # today - в строке есть счётчик жизни объявления в днях
+    return 'adverts_v2:advert-row:{0}:{1}:{2}:{3}:{4}:{5}:{6}'.format(
+        advert.pk, advert.updated.timestamp(), advert.status, status, photos_version, references_version, today)
+
+
+def render_advert_fragments(adverts, status, load=None):
+    """
+    Строки списка объявлений из кеша фрагментов; рендерятся только отсутствующие.
+    load(ids) -> {id: объявление} подгружает полные объекты для рендера промахов.
+    """
+    adverts = list(adverts)
+    versions = get_photos_versions([advert.pk for advert in adverts])
+    references_version = cache.get(REFERENCES_VERSION_KEY, 0)
+    today = timezone.localdate().isoformat()
+    keys = [get_fragment_key(advert, status, versions[advert.pk], references_version, today) for advert in adverts]
+    fragments = cache.get_many(keys)
+
+    missing = [(key, advert) for key, advert in zip(keys, adverts) if key not in fragments]
+    if missing:
+        loaded = load([advert.pk for key, advert in missing]) if load is not None else {}
+        rendered = {
+            key: render_to_string(FRAGMENT_TEMPLATE, {
+                'advert': loaded.get(advert.pk, advert),
+                'status': status,
+                'statuses': options.ADVERT_STATUSES_FULL,
+            })
+            for key, advert in missing
+        }
+        cache.set_many(rendered, FRAGMENT_CACHE_TIMEOUT)
+        fragments.update(rendered)
+    return [fragments[key] for key in keys]
+
+
+for model in ('adverts_v2.Category', City, District, Metro, Street):
+    post_save.connect(bump_references_version, sender=model)
+    post_delete.connect(bump_references_version, sender=model)
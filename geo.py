@@ -0,0 +1,47 @@
+import re
+
+from django.db.models.signals import post_save, post_delete
+
+from apps.adverts_extras.models import City, District, Metro, Street
+from .caches import VersionedLocalCache
+
+WORDS_RE = re.compile(r'\w+')
+
+
+def normalize_address(address):
+    return ' '.join(WORDS_RE.findall(address.lower().replace('ё', 'е')))
+
+
+class GeoReferences:
+    """
+    Справочники городов, районов, метро и улиц в памяти процесса: {id: название}.
+    Таблицы маленькие и меняются редко, сброс - через версию в общем кеше.
+    """
+    models = (City, District, Metro, Street)
+
+    def __init__(self):
+        self.cache = VersionedLocalCache('geo-references')
+
+    def get_titles(self, model):
+        return self.cache.get(model._meta.label_lower,
+                              lambda: dict(model._default_manager.values_list('id', 'title')))
+
+    def get_title(self, model, pk):
+        if pk is None:
+            return None
+        return self.get_titles(model).get(pk)
+
+    def invalidate(self):
+        self.cache.invalidate()
+
+
+geo_references = GeoReferences()
+
+
+def invalidate_geo_references(sender, **kwargs):
+    geo_references.invalidate()
+
+
+for model in GeoReferences.models:
+    post_save.connect(invalidate_geo_references, sender=model)
+    post_delete.connect(invalidate_geo_references, sender=model)
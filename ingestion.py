@@ -0,0 +1,370 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit, urljoin
+
+import aiohttp
+from aiohttp import web
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction, connection, IntegrityError
+
+from libs.utils import import_by_name
+from .duplicates import get_text_signature
+from .photo_hashes import dhash
+from .regeneration import detach_inherited_connections, start_workers
+from .seen_set import DonorSeenSet
+
+PARSERS_MODULE = getattr(settings, 'ADVERTS_PARSERS_MODULE', 'apps.adverts_v2.parsers')
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDonorParser:
+    """
+    Парсер донора для асинхронного сбора. Сам парсер не ходит в сеть:
+    он строит ссылки и разбирает уже скачанные страницы.
+    """
+    donor = None
+    connections_limit = 4
+
+    def __init__(self, parsing_settings):
+        self.parsing_settings = parsing_settings
+
+    def get_list_url(self, page, price_from=None, price_to=None):
+        raise NotImplementedError
+
+    def parse_list(self, html):
+        """Ссылки на объявления со страницы списка."""
+        raise NotImplementedError
+
+    def parse_detail(self, html, url):
+        """Словарь полей объявления; ссылки на фото - в ключе photos."""
+        raise NotImplementedError
+
+
+def get_record_key(url):
+    parts = urlsplit(url)
+    return hashlib.sha1('{0}?{1}'.format(parts.path, parts.query).encode('utf-8')).hexdigest()
+
+
+class IngestionStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.pages = 0
+        self.details = 0
+        self.skipped = 0
+        self.created = 0
+        self.photos = 0
+        self.errors = 0
+        self.duplicates = 0
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def as_dict(self):
+        elapsed = self.elapsed or 1
+        return {
+            'pages': self.pages,
+            'details': self.details,
+            'skipped': self.skipped,
+            'created': self.created,
+            'photos': self.photos,
+            'errors': self.errors,
+            'duplicates': self.duplicates,
+            'elapsed': round(self.elapsed, 2),
+            'pages_per_second': round((self.pages + self.details) / elapsed, 2),
+            'adverts_per_second': round(self.created / elapsed, 2),
+        }
+
+
+class IngestionEngine:
+    """
+    Асинхронный сбор объявлений по CategoryParsingSettings:
+    диапазон цен режется на окна по price_step, окна обходятся параллельно,
+    разобранные объявления идут через очередь в пакетную запись (parse -> dedupe -> bulk insert по donor_url).
+    base_url подменяет хост донора, например на локальный сервер с записанными страницами.
+    Уже собранные ссылки отсекаются по seen-set ещё до запроса в базу.
+    Сигнатуры MinHash считают процессы-воркеры до очереди, поток записи их только сохраняет.
+    """
+
+    def __init__(self, parsing_settings, parser=None, concurrency=8, batch_size=50, base_url=None, record_dir=None,
+                 seen_set=None, signature_workers=None):
+        self.parsing_settings = parsing_settings
+        self.category = parsing_settings.category
+        self.parser = parser or import_by_name(name=parsing_settings.parser_name,
+                                               module=PARSERS_MODULE)(parsing_settings)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.base_url = base_url
+        self.record_dir = record_dir
+        self.stats = IngestionStats()
+        self.seen_urls = set()
+        self.seen_set = seen_set if seen_set is not None else DonorSeenSet()
+        # ORM синхронный: все обращения к базе идут через один поток
+        self.db_executor = ThreadPoolExecutor(max_workers=1)
+        self.signature_workers = signature_workers or os.cpu_count() or 1
+
+    def get_price_windows(self):
+        price_from = self.parsing_settings.price_from
+        price_to = self.parsing_settings.price_to
+        price_step = self.parsing_settings.price_step or 1
+        if not price_to or price_to <= price_from:
+            return [(price_from or None, None)]
+        return [(price, min(price + price_step, price_to)) for price in range(price_from, price_to, price_step)]
+
+    def rewrite_url(self, url):
+        if not self.base_url:
+            return url
+        parts = urlsplit(url)
+        return urljoin(self.base_url, '{0}?{1}'.format(parts.path, parts.query) if parts.query else parts.path)
+
+    async def run_db(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.db_executor, func, *args)
+
+    async def fetch(self, session, url, binary=False):
+        async with self.semaphore:
+            try:
+                async with session.get(self.rewrite_url(url)) as response:
+                    response.raise_for_status()
+                    content = await response.read() if binary else await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                self.stats.errors += 1
+                logger.warning('Не удалось загрузить %s: %s', url, error)
+                return None
+
+        if self.record_dir:
+            # фото тоже пишем, иначе повтор прогона не найдёт их на подменном сервере
+            with open(os.path.join(self.record_dir, get_record_key(url)), 'wb') as record_file:
+                record_file.write(content if binary else content.encode('utf-8'))
+        return content
+
+    def get_existing_urls(self, urls):
+        from apps.adverts_v2.models import Advert
+
+        return Advert.objects.get_existing_donor_urls(urls)
+
+    async def filter_new_urls(self, urls):
+        urls = [url for url in urls if url not in self.seen_urls]
+        self.seen_urls.update(urls)
+        known = {url for url in urls if self.seen_set.contains(self.parser.donor, url)}
+        if known:
+            self.stats.skipped += len(known)
+            urls = [url for url in urls if url not in known]
+        existing = await self.run_db(self.get_existing_urls, urls) if urls else set()
+        self.stats.skipped += len(existing)
+        return [url for url in urls if url not in existing]
+
+    async def fetch_detail(self, session, url, queue):
+        html = await self.fetch(session, url)
+        if html is None:
+            return
+        self.stats.details += 1
+
+        try:
+            fields = self.parser.parse_detail(html, url)
+        except Exception:
+            self.stats.errors += 1
+            logger.exception('Ошибка разбора %s', url)
+            return
+        if not fields:
+            return
+
+        photo_urls = fields.pop('photos', ())
+        # сигнатура считается в процессе-воркере, пока качаются фото
+        signature = asyncio.get_event_loop().run_in_executor(
+            self.signature_executor, get_text_signature,
+            fields.get('title_original'), fields.get('description_original'))
+        photos = await asyncio.gather(*(self.fetch(session, photo_url, binary=True) for photo_url in photo_urls))
+        fields['photos'] = [(photo_url, content) for photo_url, content in zip(photo_urls, photos) if content]
+        fields['signature'] = await signature
+        await queue.put((url, fields))
+
+    async def crawl_window(self, session, queue, price_from, price_to):
+        for page in range(1, self.parsing_settings.parser_pages_limit + 1):
+            html = await self.fetch(session, self.parser.get_list_url(page, price_from, price_to))
+            if html is None:
+                break
+            self.stats.pages += 1
+
+            urls = self.parser.parse_list(html)
+            if not urls:
+                break
+            new_urls = await self.filter_new_urls(urls)
+            await asyncio.gather(*(self.fetch_detail(session, url, queue) for url in new_urls))
+
+    def build_advert(self, model, url, fields):
+        advert = model(category=self.category, donor=self.parser.donor, donor_url=url, **fields)
+        if advert.city_id is None and self.parsing_settings.city_id:
+            advert.city_id = self.parsing_settings.city_id
+        return advert
+
+    def save_photos(self, advert, photos):
+        from apps.adverts_v2.models import AdvertPhoto
+
+        for photo_url, content in photos:
+            checksum = hashlib.md5(content).hexdigest()
+            if AdvertPhoto.objects.filter(checksum=checksum).exists():
+                continue
+
+            photo = AdvertPhoto(advert=advert, checksum=checksum)
+            image_file = ContentFile(content, name=os.path.basename(urlsplit(photo_url).path) or 'photo.jpg')
+            try:
+                photo.phash = dhash(image_file)
+            except (IOError, OSError, ValueError):
+                pass
+            finally:
+                image_file.seek(0)
+
+            duplicate = None
+            if photo.phash is not None:
+                duplicate = AdvertPhoto.objects.find_duplicate(image_file, phash=photo.phash)
+            if duplicate is not None:
+                # почти такое же фото уже есть: переиспользуем файл и не рендерим вариации заново
+                photo.image = duplicate.image.name
+            else:
+                photo.image.save(image_file.name, image_file, save=False)
+            try:
+                with transaction.atomic():
+                    photo.save()
+            except IntegrityError:
+                continue
+            self.stats.photos += 1
+
+    def save_batch(self, batch):
+        from apps.adverts_v2.models import Advert, AdvertMinHash
+
+        unique = {}
+        for url, fields in batch:
+            unique.setdefault(url, fields)
+        existing = self.get_existing_urls(list(unique))
+        model = self.category.get_model()
+
+        photos = {}
+        signatures = {}
+        adverts = []
+        for url, fields in unique.items():
+            if url in existing:
+                self.stats.skipped += 1
+                continue
+            photos[url] = fields.pop('photos', ())
+            signatures[url] = fields.pop('signature', None)
+            adverts.append(self.build_advert(model, url, fields))
+
+        try:
+            Advert.objects.bulk_create_adverts(adverts)
+        except IntegrityError:
+            # параллельный сбор успел записать часть ссылок: пишем по одному
+            created = []
+            for advert in adverts:
+                advert.pk = None
+                advert._state.adding = True
+                try:
+                    with transaction.atomic():
+                        advert.save()
+                except IntegrityError:
+                    self.stats.skipped += 1
+                    continue
+                created.append(advert)
+            adverts = created
+
+        self.stats.created += len(adverts)
+        for advert in adverts:
+            self.seen_set.add(advert.donor, advert.donor_url)
+            self.save_photos(advert, photos.get(advert.donor_url, ()))
+        # дубли с других доноров только помечаем, решение остаётся за оператором
+        self.stats.duplicates += len(AdvertMinHash.objects.index_adverts(
+            adverts, signatures=[signatures[advert.donor_url] for advert in adverts]))
+        return adverts
+
+    async def store(self, queue):
+        batch = []
+        while True:
+            item = await queue.get()
+            if item is not None:
+                batch.append(item)
+            if batch and (item is None or len(batch) >= self.batch_size):
+                await self.run_db(self.save_batch, batch)
+                batch = []
+                logger.info('Сбор %s: %s', self.parsing_settings, self.stats.as_dict())
+            if item is None:
+                break
+
+    async def run(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.seen_set.open()
+        queue = asyncio.Queue(maxsize=self.batch_size * 2)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.parser.connections_limit)
+        # воркеры поднимаем до первого обращения потока записи к базе
+        self.signature_executor = ProcessPoolExecutor(self.signature_workers,
+                                                      initializer=detach_inherited_connections)
+        self.signature_executor.submit(start_workers).result()
+        try:
+            async with aiohttp.ClientSession(connector=connector) as session:
+                consumer = asyncio.ensure_future(self.store(queue))
+                crawlers = asyncio.ensure_future(asyncio.gather(*(
+                    self.crawl_window(session, queue, price_from, price_to)
+                    for price_from, price_to in self.get_price_windows()
+                )))
+                try:
+                    await asyncio.wait([consumer, crawlers], return_when=asyncio.FIRST_COMPLETED)
+                    if consumer.done():
+                        # запись завершается раньше обхода только с ошибкой: иначе обход встанет на полной очереди
+                        crawlers.cancel()
+                        consumer.result()
+                    await crawlers
+                    await queue.put(None)
+                    await consumer
+                finally:
+                    for task in (crawlers, consumer):
+                        if not task.done():
+                            task.cancel()
+        finally:
+            await self.run_db(connection.close)
+            self.db_executor.shutdown()
+            self.signature_executor.shutdown()
+            self.seen_set.close()
+        return self.stats.as_dict()
+
+
+class RecordedPagesServer:
+    """
+    Локальная подмена донора: отдаёт страницы, записанные движком с record_dir,
+    по пути и параметрам запроса. Для прогона сбора без сети - base_url движка указывает сюда.
+    """
+
+    def __init__(self, directory, host='127.0.0.1', port=0):
+        self.directory = directory
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle(self, request):
+        path = os.path.join(self.directory, get_record_key(str(request.rel_url)))
+        if not os.path.exists(path):
+            raise web.HTTPNotFound()
+        content_type = mimetypes.guess_type(request.path)[0] or 'text/html'
+        with open(path, 'rb') as record_file:
+            body = record_file.read()
+        if content_type.startswith('text/'):
+            return web.Response(body=body, content_type=content_type, charset='utf-8')
+        return web.Response(body=body, content_type=content_type)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/{tail:.*}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return 'http://{0}:{1}/'.format(self.host, self.port)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
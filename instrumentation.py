@@ -0,0 +1,196 @@
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from contextlib import contextmanager, ExitStack
+from functools import wraps
+
+import django
+from django.conf import settings
+from django.db import connections
+from django.db.backends.utils import CursorDebugWrapper
+from django.template import loader
+
+INSTRUMENTATION_ENABLED = getattr(settings, 'ADVERTS_INSTRUMENTATION', False)
+INSTRUMENTATION_SINK = getattr(settings, 'ADVERTS_INSTRUMENTATION_SINK', None)
+SLOWEST_QUERIES = getattr(settings, 'ADVERTS_INSTRUMENTATION_SLOWEST', 5)
+STACK_DEPTH = 4
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_skip_paths = (os.path.dirname(django.__file__), __file__)
+
+
+def get_active_recorders():
+    return getattr(_local, 'recorders', [])
+
+
+def get_call_site():
+    # ближайшие кадры вне django и этого модуля - то место, откуда на самом деле пришёл запрос
+    frames = [frame for frame in traceback.extract_stack() if not frame.filename.startswith(_skip_paths)]
+    return ['{0}:{1} in {2}'.format(frame.filename, frame.lineno, frame.name) for frame in frames[-STACK_DEPTH:]]
+
+
+class RecordingCursorWrapper(CursorDebugWrapper):
+    def execute(self, sql, params=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self.record(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, param_list)
+        finally:
+            self.record(sql, time.perf_counter() - start)
+
+    def record(self, sql, duration):
+        recorders = get_active_recorders()
+        if recorders:
+            call_site = get_call_site()
+            for recorder in recorders:
+                recorder.record(self.db.alias, sql, duration, call_site)
+
+
+def install_cursor_wrappers():
+    # соединения потоковые, поэтому подмена курсора видна только текущему потоку
+    _local.patched = {}
+    for connection in connections.all():
+        _local.patched[connection.alias] = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        connection.make_debug_cursor = lambda cursor, connection=connection: RecordingCursorWrapper(cursor, connection)
+
+
+def uninstall_cursor_wrappers():
+    for connection in connections.all():
+        if connection.alias in _local.patched:
+            connection.force_debug_cursor = _local.patched.pop(connection.alias)
+            connection.__dict__.pop('make_debug_cursor', None)
+
+
+class QueryRecorder:
+    """
+    Считает запросы к базе в текущем потоке: количество, суммарное время, самые медленные
+    запросы с местом вызова. Запросы раскладываются по секциям (view, шаблоны).
+    """
+
+    def __init__(self, name, slowest=SLOWEST_QUERIES):
+        self.name = name
+        self.slowest_limit = slowest
+        self.queries = 0
+        self.db_time = 0.0
+        self.duration = None
+        self.sections = {}
+        self._section_stack = ['view']
+        self._slowest = []
+        self._counter = itertools.count()
+        self._started = None
+
+    def record(self, alias, sql, duration, call_site):
+        section = self._section_stack[-1]
+        self.queries += 1
+        self.db_time += duration
+        stats = self.sections.setdefault(section, {'queries': 0, 'db_time': 0.0})
+        stats['queries'] += 1
+        stats['db_time'] += duration
+
+        item = (duration, next(self._counter), {
+            'sql': sql, 'time': round(duration, 4), 'db': alias, 'section': section, 'call_site': call_site,
+        })
+        if len(self._slowest) < self.slowest_limit:
+            heapq.heappush(self._slowest, item)
+        else:
+            heapq.heappushpop(self._slowest, item)
+
+    @contextmanager
+    def section(self, name):
+        self._section_stack.append(name)
+        try:
+            yield self
+        finally:
+            self._section_stack.pop()
+
+    def __enter__(self):
+        recorders = _local.__dict__.setdefault('recorders', [])
+        if not recorders:
+            install_cursor_wrappers()
+        recorders.append(self)
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.perf_counter() - self._started
+        _local.recorders.remove(self)
+        if not _local.recorders:
+            uninstall_cursor_wrappers()
+
+    @property
+    def slowest(self):
+        return [item for duration, counter, item in sorted(self._slowest, reverse=True)]
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'queries': self.queries,
+            'db_time': round(self.db_time, 4),
+            'duration': round(self.duration, 4) if self.duration is not None else None,
+            'sections': {name: dict(stats, db_time=round(stats['db_time'], 4))
+                         for name, stats in self.sections.items()},
+            'slowest': self.slowest,
+        }
+
+
+@contextmanager
+def section(name):
+    with ExitStack() as stack:
+        for recorder in get_active_recorders():
+            stack.enter_context(recorder.section(name))
+        yield
+
+
+def render_to_string(template_name, context=None, request=None, using=None):
+    """render_to_string, запросы которого попадают в секцию шаблона."""
+    with section(template_name):
+        return loader.render_to_string(template_name, context, request=request, using=using)
+
+
+def write_report(report):
+    logger.info('%s: %s queries, %.1f ms in db', report['name'], report['queries'], report['db_time'] * 1000,
+                extra={'report': report})
+    if INSTRUMENTATION_SINK:
+        with open(INSTRUMENTATION_SINK, 'a', encoding='utf-8') as sink:
+            sink.write(json.dumps(report, ensure_ascii=False, default=str) + '\n')
+
+
+def instrument_view(view):
+    """
+    Включается настройкой ADVERTS_INSTRUMENTATION. TemplateResponse рендерится здесь же,
+    чтобы запросы из шаблона попали в отчёт; тело потоковых ответов не учитывается.
+    """
+    if not INSTRUMENTATION_ENABLED:
+        return view
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        name = getattr(request.resolver_match, 'view_name', None) or request.path
+        with QueryRecorder(name) as recorder:
+            response = view(request, *args, **kwargs)
+            if hasattr(response, 'render') and not response.is_rendered:
+                template_name = response.template_name
+                if not isinstance(template_name, str):
+                    template_name = ', '.join(template_name)
+                with recorder.section(template_name):
+                    response.render()
+
+        report = recorder.as_dict()
+        report.update(path=request.path, method=request.method, status=response.status_code)
+        write_report(report)
+        return response
+    return wrapper
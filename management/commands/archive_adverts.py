@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from apps.adverts_v2.models import ArchivedAdvert
+
+
+class Command(BaseCommand):
+    help = 'Переносит старые использованные и отклонённые объявления в архив'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=None, help='Возраст в днях по дате смены статуса')
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **kwargs):
+        total = 0
+        for count in ArchivedAdvert.objects.archive(older_than=kwargs['older_than'],
+                                                    chunk_size=kwargs['chunk_size']):
+            total += count
+            self.stdout.write('Перенесено в архив: {0}'.format(total))
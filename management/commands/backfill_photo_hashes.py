@@ -0,0 +1,47 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from apps.adverts_v2.models import AdvertPhoto
+from apps.adverts_v2.photo_hashes import dhash, photo_hash_index
+
+
+def compute_hash(path):
+    try:
+        return dhash(path)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Заполняет перцептивные хеши у фото, для которых они ещё не посчитаны'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=None, help='Количество процессов')
+
+    def handle(self, *args, **kwargs):
+        chunk_size = kwargs['chunk_size']
+        queryset = AdvertPhoto.objects.filter(phash=None).order_by('id')
+        processed = hashed = 0
+        last_id = 0
+
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=kwargs['workers']) as executor:
+            while True:
+                photos = list(queryset.filter(id__gt=last_id).values_list('id', 'image')[:chunk_size])
+                if not photos:
+                    break
+                last_id = photos[-1][0]
+
+                ids = [pk for pk, _ in photos]
+                paths = [AdvertPhoto._meta.get_field('image').storage.path(name) for _, name in photos]
+                for pk, phash in zip(ids, executor.map(compute_hash, paths)):
+                    if phash is not None:
+                        AdvertPhoto.objects.filter(pk=pk).update(phash=phash)
+                        hashed += 1
+                processed += len(photos)
+                self.stdout.write('Обработано фото: {0}, посчитано хешей: {1}'.format(processed, hashed))
+
+        photo_hash_index.invalidate()
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from apps.adverts_v2.duplicates import DUPLICATE_SIMILARITY
+from apps.adverts_v2.models import AdvertMinHash
+
+
+class Command(BaseCommand):
+    help = 'Считает сигнатуры текстов и группирует дубли объявлений разных доноров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--similarity', type=float, default=DUPLICATE_SIMILARITY)
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **kwargs):
+        indexed = AdvertMinHash.objects.index_missing(kwargs['chunk_size'])
+        self.stdout.write('Посчитано сигнатур: {0}'.format(indexed))
+
+        groups = AdvertMinHash.objects.cluster(kwargs['similarity'], kwargs['chunk_size'])
+        self.stdout.write('Кластеров дублей: {0}, объявлений в них: {1}'.format(
+            len(groups), sum(len(members) for members in groups)))
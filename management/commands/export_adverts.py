@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.adverts_v2.exports import AdvertExporter, CONTENT_TYPES
+from apps.adverts_v2.models import Category
+
+
+class Command(BaseCommand):
+    help = 'Потоковая выгрузка объявлений категории в CSV или JSONL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('category', help='ЧПУ категории')
+        parser.add_argument('--format', choices=sorted(CONTENT_TYPES), default='csv')
+        parser.add_argument('--status', type=int, action='append', help='Статус (можно несколько)')
+        parser.add_argument('--output', default=None, help='Файл (по умолчанию stdout)')
+
+    def handle(self, *args, **kwargs):
+        category = Category.objects.filter(alias=kwargs['category']).first()
+        if category is None:
+            raise CommandError('Категория {0} не найдена'.format(kwargs['category']))
+
+        exporter = AdvertExporter(category, kwargs['status'])
+        chunks = exporter.stream(kwargs['format'])
+        if kwargs['output'] is None:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+
+        with open(kwargs['output'], 'w', encoding='utf-8', newline='') as output:
+            output.writelines(chunks)
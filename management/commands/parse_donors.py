@@ -0,0 +1,31 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from apps.adverts_v2.ingestion import IngestionEngine
+from apps.adverts_v2.models import CategoryParsingSettings
+
+
+class Command(BaseCommand):
+    help = 'Асинхронный сбор объявлений по активным настройкам парсинга'
+
+    def add_arguments(self, parser):
+        parser.add_argument('settings_ids', nargs='*', type=int,
+                            help='id настроек парсинга (по умолчанию все активные)')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--base-url', default=None, help='Подменить хост донора, например на сервер с записями')
+        parser.add_argument('--record-dir', default=None, help='Сохранять загруженные страницы в каталог')
+
+    def handle(self, *args, **kwargs):
+        queryset = CategoryParsingSettings.objects.filter(is_active=True).select_related('category')
+        if kwargs['settings_ids']:
+            queryset = queryset.filter(id__in=kwargs['settings_ids'])
+
+        loop = asyncio.get_event_loop()
+        for parsing_settings in queryset:
+            engine = IngestionEngine(parsing_settings, concurrency=kwargs['concurrency'],
+                                     batch_size=kwargs['batch_size'], base_url=kwargs['base_url'],
+                                     record_dir=kwargs['record_dir'])
+            stats = loop.run_until_complete(engine.run())
+            self.stdout.write('{0}: {1}'.format(parsing_settings, stats))
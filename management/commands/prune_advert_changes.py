@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from apps.adverts_v2.models import AdvertChangeEvent
+
+
+class Command(BaseCommand):
+    help = 'Удаляет старые записи ленты изменений объявлений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-hours', type=int, default=None)
+
+    def handle(self, *args, **kwargs):
+        count = AdvertChangeEvent.objects.prune(kwargs['keep_hours'])
+        self.stdout.write('Удалено записей: {0}'.format(count))
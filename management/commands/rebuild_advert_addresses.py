@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.adverts_v2.geo import normalize_address
+from apps.adverts_v2.models import ApartmentAdvert
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает нормализованные адреса квартир'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **kwargs):
+        queryset = ApartmentAdvert._base_manager.only(
+            'id', 'city', 'district', 'street', 'house_number', 'address_normalized').order_by('id')
+        last_id = updated = 0
+        while True:
+            chunk = list(queryset.filter(id__gt=last_id)[:kwargs['chunk_size']])
+            if not chunk:
+                break
+            with transaction.atomic():
+                for advert in chunk:
+                    address_normalized = normalize_address(advert.address)[:255]
+                    if advert.address_normalized != address_normalized:
+                        ApartmentAdvert._base_manager.filter(pk=advert.pk).update(
+                            address_normalized=address_normalized)
+                        updated += 1
+            last_id = chunk[-1].id
+        self.stdout.write('Обновлено адресов: {0}'.format(updated))
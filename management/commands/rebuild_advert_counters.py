@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from apps.adverts_v2.models import Category, AdvertStatusCounter
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счётчики объявлений по статусам и объявлений в работе'
+
+    def add_arguments(self, parser):
+        parser.add_argument('categories', nargs='*', help='ЧПУ категорий (по умолчанию все)')
+
+    def handle(self, *args, **kwargs):
+        categories = Category.objects.all()
+        if kwargs['categories']:
+            categories = categories.filter(alias__in=kwargs['categories'])
+
+        for category in categories:
+            counts = AdvertStatusCounter.objects.rebuild(category)
+            self.stdout.write('{0}: {1}'.format(category.alias, counts))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from apps.adverts_v2.seen_set import SEEN_SET_PATH, rebuild_seen_set
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает файл уже собранных ссылок доноров по объявлениям и архиву'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=SEEN_SET_PATH)
+
+    def handle(self, *args, **kwargs):
+        count = rebuild_seen_set(kwargs['path'])
+        self.stdout.write('Записано ссылок: {0} ({1})'.format(count, kwargs['path']))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.adverts_v2.models import Category, TextRegenerationJob
+from apps.adverts_v2.regeneration import TextRegenerator
+
+
+class Command(BaseCommand):
+    help = 'Перегенерирует текстовое поле у всех объявлений категории; прерванная задача продолжается'
+
+    def add_arguments(self, parser):
+        parser.add_argument('category', help='ЧПУ категории')
+        parser.add_argument('field', help='Поле, например description')
+        parser.add_argument('--chunk-size', type=int, default=200)
+        parser.add_argument('--workers', type=int, default=None)
+        parser.add_argument('--restart', action='store_true', help='Начать заново, а не продолжить')
+
+    def handle(self, *args, **kwargs):
+        category = Category.objects.filter(alias=kwargs['category']).first()
+        if category is None:
+            raise CommandError('Категория {0} не найдена'.format(kwargs['category']))
+        job = TextRegenerationJob.objects.get_or_start(category, kwargs['field'], restart=kwargs['restart'])
+        if job.processed:
+            self.stdout.write('Продолжаем с объявления #{0}'.format(job.last_id))
+
+        def progress(job):
+            self.stdout.write('{0}/{1} ({2}%)'.format(job.processed, job.total, job.progress))
+
+        TextRegenerator(job, kwargs['chunk_size'], kwargs['workers']).run(progress)
+        self.stdout.write('Готово: {0}'.format(job.processed))
@@ -0,0 +1,47 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from apps.adverts_v2.models import AdvertPhoto
+from apps.adverts_v2.photo_variations import render_all_variations
+
+
+def render_photo(file_name, replace):
+    try:
+        return render_all_variations(file_name, replace=replace)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Фоновый рендер вариаций фото (по умолчанию только для включённых фото)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Рендерить и для отключённых фото')
+        parser.add_argument('--replace', action='store_true', help='Перерисовать уже существующие вариации')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=None, help='Количество процессов')
+
+    def handle(self, *args, **kwargs):
+        queryset = AdvertPhoto.objects.order_by('id')
+        if not kwargs['all']:
+            queryset = queryset.filter(enabled=True)
+
+        processed = 0
+        last_id = 0
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=kwargs['workers']) as executor:
+            while True:
+                photos = list(queryset.filter(id__gt=last_id).values_list('id', 'image')[:kwargs['chunk_size']])
+                if not photos:
+                    break
+                last_id = photos[-1][0]
+
+                names = [name for _, name in photos]
+                replace = [kwargs['replace']] * len(names)
+                for file_name, rendered in zip(names, executor.map(render_photo, names, replace)):
+                    processed += 1
+                    if rendered is None:
+                        self.stderr.write('Не удалось обработать {0}'.format(file_name))
+                self.stdout.write('Обработано фото: {0}'.format(processed))
@@ -1,22 +1,41 @@
+import time
+from collections import Counter
+from datetime import timedelta
 from random import shuffle
 
 from django.apps import apps
 from django.conf import settings
-from django.core.exceptions import FieldDoesNotExist
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.urlresolvers import reverse
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import models, transaction, connections, IntegrityError
+from django.db.models import F, Q, Case, When, Sum, Count, Max
+from django.db.models.constants import LOOKUP_SEP
+from django.utils import timezone
 from model_utils.managers import InheritanceQuerySet
 from smart_selects.db_fields import ChainedForeignKey
 
 from apps.adverts_extras.models import City, Street, District, Metro
-from apps.adverts_generator_v2.models import PhraseGroupSet
-from apps.adverts_v2.forms import modelform_fabric
-from libs.stdimage import StdImageField, ACTION_CROP
-from libs.utils import import_by_name
+from libs.stdimage import StdImageField
 from . import options
+from .duplicates import (DUPLICATE_SIMILARITY, DUPLICATE_BUCKET_LIMIT, DUPLICATE_BUCKET_LEADERS, UnionFind,
+                         get_text_signature, get_bands, get_similarity)
+from .fragments import bump_photos_version
+from .geo import geo_references, normalize_address
+from .phrases import phrase_groupsets
+from .photo_hashes import dhash, photo_hash_index, DUPLICATE_DISTANCE
+from .photo_variations import PHOTO_VARIATIONS, render_variations_on_save
+from .registries import category_classes
+from .search import SEARCH_FIELD_NAMES, get_search_vector, search_queryset
 
 __all__ = ('Category', 'CategoryParsingSettings', 'Advert', 'ApartmentAdvert', 'AdvertPhoto', 'AdvertInWork',
-           'CottageAdvert')
+           'CottageAdvert', 'AdvertStatusCounter', 'AdvertInWorkCounter', 'AdvertMinHash', 'ArchivedAdvert',
+           'ArchivedAdvertPhoto', 'TextRegenerationJob', 'AdvertChangeEvent')
 
 
 class Category(models.Model):
@@ -37,13 +56,13 @@ class Category(models.Model):
         return apps.get_model(self._meta.app_label, self.model_name)
 
     def get_change_form_class(self):
-        return modelform_fabric(model=self.get_model())
+        return category_classes.get(self).form_class
 
     def get_archive_builder_class(self):
-        return import_by_name(name=self.builder_class_name, module=options.ARCHIVE_BUILDERS_MODULE)
+        return category_classes.get(self).builder_class
 
     def get_adverts_queryset(self):
-        return Advert.objects.get_category_queryset(category_alias=self.alias).order_by('created')
+        return Advert.objects.get_category_queryset(category=self).order_by('created', 'id')
 
 
 class CategoryParsingSettings(models.Model):
@@ -92,13 +111,189 @@ class AdvertsQueryset(InheritanceQuerySet):
             return self.get_adverts_in_work(user)
         return self.available().filter(status=status)
 
+    def for_list(self):
+        # связанные объекты подклассов подтягиваем через их путь, иначе у подкласса кеш будет пустым
+        related = list(self.model.list_related_fields)
+        for path in getattr(self, 'subclasses', ()):
+            model = self.model
+            for name in path.split(LOOKUP_SEP):
+                model = model._meta.get_field(name).related_model
+            related.extend('{0}{1}{2}'.format(path, LOOKUP_SEP, name) for name in model.list_related_fields)
+        return self.select_related(*related).prefetch_related('photos')
+
+    def search(self, query):
+        return search_queryset(self, query)
+
+    def update_search_vectors(self):
+        return self.update(search_vector=get_search_vector())
+
+    def filter_address(self, address):
+        lookup = 'address_normalized__startswith'
+        if self.model is not ApartmentAdvert:
+            lookup = ApartmentAdvert._meta.model_name + LOOKUP_SEP + lookup
+        return self.filter(**{lookup: normalize_address(address)})
+
 
 class AdvertsManager(models.Manager):
     def get_queryset(self):
         return super().get_queryset().select_subclasses()
 
-    def get_category_queryset(self, category_alias):
-        return self.get_queryset().filter(category__alias=category_alias)
+    def get_model_queryset(self, model):
+        queryset = super().get_queryset()
+        if model is self.model:
+            return queryset
+        return queryset.select_subclasses(model)
+
+    def get_category_queryset(self, category_alias=None, category=None):
+        if category is None:
+            return self.get_queryset().filter(category__alias=category_alias)
+        # в категории лежат объявления одной модели, поэтому присоединяем только её таблицу
+        return self.get_model_queryset(category.get_model()).filter(category=category)
+
+    def get_existing_donor_urls(self, urls):
+        # урл занят, даже если объявление уже уехало в архив
+        urls = list(urls)
+        existing = set(Advert._base_manager.using(self.db).filter(
+            donor_url__in=urls).values_list('donor_url', flat=True))
+        existing.update(ArchivedAdvert.objects.using(self.db).filter(
+            donor_url__in=urls).values_list('donor_url', flat=True))
+        return existing
+
+    def claim_new_adverts(self, category, user, count):
+        queryset = Advert._base_manager.using(self.db).filter(
+            category=category, visible=True, status=options.NEW,
+        ).exclude(
+            # NOT IN вместо LEFT JOIN: FOR UPDATE нельзя применять к nullable-стороне внешнего соединения
+            pk__in=AdvertInWork.objects.values('advert_id'),
+        ).order_by('created', 'id')
+
+        for attempt in range(2):
+            try:
+                with transaction.atomic(using=self.db):
+                    advert_ids = list(queryset.select_for_update(skip_locked=True).values_list('id', flat=True)[:count])
+                    AdvertInWork.objects.using(self.db).bulk_create(
+                        AdvertInWork(advert_id=advert_id, user=user) for advert_id in advert_ids)
+                    AdvertStatusCounter.objects.move(category.id, (options.NEW, None), (options.IN_WORK, user.pk),
+                                                     count=len(advert_ids), advert_ids=advert_ids, user_id=user.pk)
+                return advert_ids
+            except IntegrityError:
+                # объявление успели взять в работу поштучно между снимком и блокировкой
+                if attempt:
+                    raise
+
+    def change_status_bulk(self, category, advert_ids, status, user):
+        errors = {}
+        changed_ids = []
+        deltas = Counter()
+
+        with transaction.atomic(using=self.db):
+            rows = list(Advert._base_manager.using(self.db).filter(category=category, pk__in=advert_ids)
+                        .select_for_update().values_list('id', 'status', 'visible'))
+            in_work = dict(AdvertInWork.objects.using(self.db).filter(
+                advert_id__in=[advert_id for advert_id, _, _ in rows]).values_list('advert_id', 'user_id'))
+
+            for advert_id, advert_status, visible in rows:
+                in_work_user_id = in_work.get(advert_id)
+                if not visible:
+                    errors[advert_id] = 'Объявление не активно.'
+                    continue
+                if in_work_user_id is not None and in_work_user_id != user.pk:
+                    errors[advert_id] = 'Объявление находится в работе у другого пользователя.'
+                    continue
+                if advert_status == status:
+                    continue
+
+                changed_ids.append(advert_id)
+                deltas[Advert.build_counter_bucket(advert_status, visible, in_work_user_id)] -= 1
+                deltas[Advert.build_counter_bucket(
+                    status, visible, user.pk if status == options.IN_WORK else None)] += 1
+
+            found_ids = {advert_id for advert_id, _, _ in rows}
+            for advert_id in advert_ids:
+                if advert_id not in found_ids:
+                    errors[advert_id] = 'Объявление не найдено.'
+
+            if changed_ids:
+                Advert._base_manager.using(self.db).filter(pk__in=changed_ids).update(
+                    status=status, status_changed=timezone.now())
+                if status == options.IN_WORK:
+                    AdvertInWork.objects.using(self.db).bulk_create(
+                        AdvertInWork(advert_id=advert_id, user=user)
+                        for advert_id in changed_ids if advert_id not in in_work)
+                else:
+                    AdvertInWork.objects.using(self.db).filter(advert_id__in=changed_ids).delete()
+                deltas.pop(None, None)
+                AdvertStatusCounter.objects.apply(category.id, deltas, advert_ids=changed_ids, user_id=user.pk)
+
+        return changed_ids, errors
+
+    def bulk_create_adverts(self, adverts, batch_size=None):
+        adverts = list(adverts)
+        if not adverts:
+            return adverts
+
+        model = type(adverts[0])
+        if any(type(advert) is not model for advert in adverts):
+            raise ValueError('All adverts must be instances of the same model')
+
+        with transaction.atomic(using=self.db):
+            pool = phrase_groupsets.load_pool({advert.category_id for advert in adverts}, options.AUTO_GENERATED_FIELDS)
+            for advert in adverts:
+                advert.populate_defaults(pool=pool)
+
+            if not connections[self.db].features.can_return_ids_from_bulk_insert:
+                # без RETURNING не узнать первичные ключи родительских строк
+                for advert in adverts:
+                    advert.save(using=self.db)
+                return adverts
+
+            self._bulk_insert(model, adverts, batch_size)
+            Advert.objects.get_model_queryset(Advert).using(self.db).filter(
+                pk__in=[advert.pk for advert in adverts],
+            ).update_search_vectors()
+
+            deltas = {}
+            category_advert_ids = {}
+            for advert in adverts:
+                bucket = advert.get_counter_bucket()
+                if bucket is not None:
+                    category_deltas = deltas.setdefault(advert.category_id, Counter())
+                    category_deltas[bucket] += 1
+                    category_advert_ids.setdefault(advert.category_id, []).append(advert.pk)
+            for category_id, category_deltas in deltas.items():
+                AdvertStatusCounter.objects.apply(category_id, category_deltas,
+                                                  advert_ids=category_advert_ids[category_id])
+        return adverts
+
+    def _bulk_insert(self, model, adverts, batch_size):
+        # multi-table наследование: сначала корневая таблица, затем таблицы подклассов по цепочке
+        chain = list(reversed(model._meta.get_parent_list())) + [model]
+        root = chain[0]
+        if root is model:
+            root._base_manager.using(self.db).bulk_create(adverts, batch_size=batch_size)
+        else:
+            root_objects = [root(**{field.attname: getattr(advert, field.attname)
+                                    for field in root._meta.concrete_fields}) for advert in adverts]
+            root._base_manager.using(self.db).bulk_create(root_objects, batch_size=batch_size)
+            for advert, root_object in zip(adverts, root_objects):
+                for field in root._meta.concrete_fields:
+                    setattr(advert, field.attname, getattr(root_object, field.attname))
+
+        ops = connections[self.db].ops
+        root_pk = root._meta.pk.attname
+        for level in chain[1:]:
+            fields = level._meta.local_concrete_fields
+            for advert in adverts:
+                # у подкласса advert.pk - это ещё пустой указатель на родителя, ключ берём из корневой таблицы
+                setattr(advert, level._meta.pk.attname, getattr(advert, root_pk))
+            size = batch_size or max(ops.bulk_batch_size(fields, adverts), 1)
+            for start in range(0, len(adverts), size):
+                level._base_manager._insert(adverts[start:start + size], fields=fields, using=self.db)
+
+        for advert in adverts:
+            advert._state.adding = False
+            advert._state.db = self.db
+            advert._counter_state = advert.status, advert.visible
 
 
 class Advert(models.Model):
@@ -124,20 +319,77 @@ class Advert(models.Model):
 
     created = models.DateTimeField(verbose_name='Дата добавления', auto_now_add=True)
     updated = models.DateTimeField(verbose_name='Дата изменения', auto_now=True)
+    status_changed = models.DateTimeField(verbose_name='Дата смены статуса', null=True, blank=True, editable=False,
+                                          db_index=True)
+
+    search_vector = SearchVectorField(verbose_name='Поисковый вектор', null=True, editable=False)
 
     objects = AdvertsManager.from_queryset(AdvertsQueryset)()
 
+    list_related_fields = ('category', 'city', 'district', 'metro')
+
     class Meta:
         verbose_name = 'объявление'
         verbose_name_plural = 'объявления'
         ordering = ('-created', )
+        index_together = (('category', 'created', 'id'), )
+        indexes = [GinIndex(fields=['search_vector'], name='adverts_v2_advert_search_gin')]
 
     def __str__(self):
         return 'Объявление #{0} в категории {1}'.format(self.id, self.category.title)
 
+    def validate_unique(self, exclude=None):
+        super().validate_unique(exclude=exclude)
+        if exclude and 'donor_url' in exclude:
+            return
+        if ArchivedAdvert.objects.filter(donor_url=self.donor_url).exclude(pk=self.pk).exists():
+            raise ValidationError({'donor_url': 'Объявление с таким урлом уже есть в архиве'})
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # отложенные поля не трогаем, чтобы не вызвать лишний запрос
+        if 'status' in instance.__dict__ and 'visible' in instance.__dict__:
+            instance._counter_state = instance.status, instance.visible
+        return instance
+
     def save(self, *args, **kwargs):
-        self.generate_texts(overwrite=False)
-        super().save(*args, **kwargs)
+        self.populate_defaults()
+
+        adding = self._state.adding
+        saved_state = getattr(self, '_counter_state', None)
+        update_fields = kwargs.get('update_fields')
+        if (adding or saved_state is not None and saved_state[0] != self.status) and (
+                update_fields is None or 'status' in update_fields):
+            # по этой дате архив отсчитывает возраст объявления в конечном статусе
+            self.status_changed = timezone.now()
+            if update_fields is not None:
+                update_fields = kwargs['update_fields'] = list(update_fields) + ['status_changed']
+        if not adding and (saved_state in (None, (self.status, self.visible)) or
+                           update_fields is not None and not {'status', 'visible'} & set(update_fields)):
+            super().save(*args, **kwargs)
+            self.update_search_vector(update_fields)
+            return
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                source, target = None, self.get_counter_bucket()
+            else:
+                in_work_user_id = AdvertInWork.objects.filter(advert=self).values_list('user_id', flat=True).first()
+                source = self.build_counter_bucket(*saved_state, in_work_user_id=in_work_user_id)
+                target = self.get_counter_bucket(in_work_user_id)
+            AdvertStatusCounter.objects.move(self.category_id, source, target, advert_ids=(self.pk, ))
+        self._counter_state = self.status, self.visible
+        self.update_search_vector(update_fields)
+
+    def update_search_vector(self, update_fields=None):
+        if update_fields is not None and not SEARCH_FIELD_NAMES & set(update_fields):
+            return
+        Advert.objects.get_model_queryset(Advert).filter(pk=self.pk).update_search_vectors()
+
+    def populate_defaults(self, pool=None):
+        self.generate_texts(overwrite=False, pool=pool)
 
     def get_change_form_class(self):
         return self.category.get_change_form_class()
@@ -151,13 +403,31 @@ class Advert(models.Model):
     def short_stats(self):
         return list(self.short_stats_items_generator)[:options.ADVERT_DETALIZATION_ITEMS_LIMIT]
 
+    def find_photo_duplicates(self, max_distance=DUPLICATE_DISTANCE):
+        advert_ids = set()
+        for photo in self.photos.exclude(phash=None):
+            similar = AdvertPhoto.objects.find_similar(photo.phash, max_distance).exclude(advert_id=self.pk)
+            advert_ids.update(similar.values_list('advert_id', flat=True))
+        return Advert.objects.filter(pk__in=advert_ids).exclude(donor=self.donor)
+
+    def find_text_duplicates(self):
+        entry = AdvertMinHash.objects.filter(advert=self).first()
+        if entry is None:
+            return Advert.objects.none()
+        root_id = entry.duplicate_of_id or self.pk
+        return Advert.objects.filter(Q(pk=root_id) | Q(minhash__duplicate_of=root_id)).exclude(pk=self.pk)
+
+    @property
+    def enabled_photos(self):
+        return [photo for photo in self.photos.all() if photo.enabled]
+
     @property
     def days_count_all(self):
         from django.utils import timezone
         now = timezone.now()
         return (now - self.created).days
 
-    def generate_texts(self, fields=None, overwrite=True):
+    def generate_texts(self, fields=None, overwrite=True, pool=None):
         for field_name in fields or options.AUTO_GENERATED_FIELDS:
             try:
                 self._meta.get_field(field_name)
@@ -167,10 +437,10 @@ class Advert(models.Model):
             if not overwrite and getattr(self, field_name):
                 continue
 
-            new_text = self.generate_text(field_name, exists_check=False)
+            new_text = self.generate_text(field_name, exists_check=False, pool=pool)
             setattr(self, field_name, new_text)
 
-    def generate_text(self, field_name, exists_check=True):
+    def generate_text(self, field_name, exists_check=True, pool=None):
         if field_name not in options.AUTO_GENERATED_FIELDS:
             raise ValueError('Field {} is not enabled for text generation'.format(field_name))
 
@@ -178,7 +448,7 @@ class Advert(models.Model):
         if exists_check:
             self._meta.get_field(field_name)
 
-        groupset = PhraseGroupSet.objects.filter(category=self.category, advert_field=field_name).order_by('?').first()
+        groupset = (phrase_groupsets if pool is None else pool).pick(self.category_id, field_name)
         return groupset.generate_text_from_object(self) if groupset else ''
 
     def can_edit(self, user):
@@ -195,20 +465,86 @@ class Advert(models.Model):
 
         return True, None
 
+    @staticmethod
+    def build_counter_bucket(status, visible, in_work_user_id=None):
+        if not visible:
+            return None
+        if in_work_user_id is not None:
+            return options.IN_WORK, in_work_user_id
+        if status == options.IN_WORK:
+            return None
+        return status, None
+
+    def get_counter_bucket(self, in_work_user_id=None):
+        return self.build_counter_bucket(self.status, self.visible, in_work_user_id=in_work_user_id)
+
+    def add_to_work(self, user):
+        with transaction.atomic():
+            # блокировка строки, чтобы пакетный захват пропустил это объявление
+            list(Advert._base_manager.select_for_update().filter(pk=self.pk).values_list('pk', flat=True))
+            in_work, created = AdvertInWork.objects.get_or_create(advert=self, user=user)
+            if created:
+                AdvertStatusCounter.objects.move(self.category_id, self.get_counter_bucket(),
+                                                 self.get_counter_bucket(user.pk), advert_ids=(self.pk, ),
+                                                 user_id=user.pk)
+        return in_work
+
+    def remove_from_work(self):
+        with transaction.atomic():
+            in_work_user_id = AdvertInWork.objects.filter(advert=self).values_list('user_id', flat=True).first()
+            if in_work_user_id is not None:
+                AdvertInWork.objects.filter(advert=self).delete()
+                AdvertStatusCounter.objects.move(self.category_id, self.get_counter_bucket(in_work_user_id),
+                                                 self.get_counter_bucket(), advert_ids=(self.pk, ),
+                                                 user_id=in_work_user_id)
+
+    def change_status(self, status, user):
+        if self.status == status:
+            return
+
+        with transaction.atomic():
+            self.status = status
+            self.save(update_fields=('status', ))
+            if status == options.IN_WORK:
+                self.add_to_work(user)
+            else:
+                self.remove_from_work()
+
+
+class AdvertPhotoManager(models.Manager):
+    def find_similar(self, phash, max_distance=DUPLICATE_DISTANCE):
+        found = photo_hash_index.search(phash, max_distance)
+        return self.filter(pk__in=[pk for _, pk in found])
+
+    def find_duplicate(self, image_file, max_distance=DUPLICATE_DISTANCE, phash=None):
+        # готовый хеш можно передать, чтобы не считать его второй раз
+        if phash is None:
+            try:
+                phash = dhash(image_file)
+            except (IOError, OSError, ValueError):
+                return None
+            finally:
+                image_file.seek(0)
+
+        found = photo_hash_index.search(phash, max_distance)
+        photos = self.in_bulk([pk for _, pk in found])
+        for _, pk in found:
+            if pk in photos:
+                return photos[pk]
+        return None
+
 
 class AdvertPhoto(models.Model):
     advert = models.ForeignKey(Advert, verbose_name='Объявление', related_name='photos')
     image = StdImageField(verbose_name='Фото', upload_to=options.ADVERTS_PHOTOS_PATH, crop_area=False,
-                          variations={
-                              'small': dict(
-                                  size=options.ADVERTS_PHOTOS_SMALL_SIZE,
-                                  action=ACTION_CROP,
-                              ),
-                              'admin_thumbnail': dict(alias_for='small'),
-                          })
+                          variations=PHOTO_VARIATIONS, render_variations=render_variations_on_save)
     checksum = models.CharField(verbose_name='Контрольная сумма', max_length=100, unique=True)
     enabled = models.BooleanField(verbose_name='Активна', default=True)
     is_main = models.BooleanField(verbose_name='Главная', default=False)
+    phash = models.BigIntegerField(verbose_name='Перцептивный хеш', null=True, blank=True, db_index=True,
+                                   editable=False)
+
+    objects = AdvertPhotoManager()
 
     class Meta:
         verbose_name = 'фото к объявлению'
@@ -217,6 +553,33 @@ class AdvertPhoto(models.Model):
     def __str__(self):
         return 'Фото к объявлению {0}'.format(self.advert)
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        # при частичном сохранении без phash хеш всё равно не попадёт в базу, не читаем файл зря
+        if self.phash is None and self.image and (update_fields is None or 'phash' in update_fields):
+            self.phash = self.compute_phash()
+        super().save(*args, **kwargs)
+        # строки списка с фото этого объявления больше не актуальны
+        bump_photos_version(self.advert_id)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        bump_photos_version(self.advert_id)
+        return result
+
+    def get_variation_url(self, variation):
+        return reverse('adverts_v2:photo-variation', args=(self.id, variation))
+
+    def compute_phash(self):
+        try:
+            self.image.open('rb')
+            try:
+                return dhash(self.image)
+            finally:
+                self.image.seek(0)
+        except (IOError, OSError, ValueError):
+            return None
+
     def can_edit(self, user):
         return self.advert.can_edit(user)
 
@@ -233,10 +596,537 @@ class AdvertInWork(models.Model):
         return '{0} в работе у пользователя {1}'.format(self.advert, self.user)
 
 
+class AdvertStatusCounterManager(models.Manager):
+    def get_counts(self, category, user):
+        counts = dict(self.filter(category=category).values_list('status', 'count'))
+        if not counts:
+            counts = self.rebuild(category)
+
+        counts[options.IN_WORK] = AdvertInWorkCounter.objects.filter(
+            category=category, user=user).values_list('count', flat=True).first() or 0
+        return {value: counts.get(value, 0) for value, _ in options.ADVERT_STATUSES}
+
+    def rebuild(self, category):
+        statuses = [value for value, _ in options.ADVERT_STATUSES if value != options.IN_WORK]
+
+        with transaction.atomic():
+            # блокируем категорию, чтобы параллельные пересчёты не конфликтовали на уникальном индексе
+            self.lock_category(category.pk)
+
+            aggregated = Advert._base_manager.filter(category=category, visible=True, advertinwork=None).aggregate(**{
+                'status_{}'.format(value): Sum(Case(When(status=value, then=1), default=0,
+                                                    output_field=models.IntegerField()))
+                for value in statuses
+            })
+            counts = {value: aggregated['status_{}'.format(value)] or 0 for value in statuses}
+            in_work_counts = AdvertInWork.objects.filter(
+                advert__category=category, advert__visible=True).values_list('user').annotate(count=Count('id'))
+
+            self.filter(category=category).delete()
+            self.bulk_create(self.model(category=category, status=value, count=count)
+                             for value, count in counts.items())
+
+            AdvertInWorkCounter.objects.filter(category=category).delete()
+            AdvertInWorkCounter.objects.bulk_create(AdvertInWorkCounter(category=category, user_id=user_id, count=count)
+                                                    for user_id, count in in_work_counts)
+        return counts
+
+    def lock_category(self, category_id):
+        list(Category.objects.select_for_update().filter(pk=category_id).values_list('pk', flat=True))
+
+    def apply(self, category_id, deltas, advert_ids=(), user_id=None):
+        deltas = {key: delta for key, delta in deltas.items() if delta}
+        if not deltas:
+            return
+
+        with transaction.atomic():
+            # та же блокировка, что и в rebuild: иначе сдвиг может попасть между пересчётом и записью счётчиков
+            self.lock_category(category_id)
+            for (status, in_work_user_id), delta in deltas.items():
+                if status == options.IN_WORK:
+                    AdvertInWorkCounter.objects.shift(category_id, in_work_user_id, delta)
+                else:
+                    self.filter(category_id=category_id, status=status).update(count=F('count') + delta)
+            # каждое изменение счётчиков попадает в ленту, её ждут экраны операторов
+            AdvertChangeEvent.objects.record(category_id, deltas, advert_ids, user_id)
+
+    def move(self, category_id, source, target, count=1, advert_ids=(), user_id=None):
+        deltas = Counter()
+        if source is not None:
+            deltas[source] -= count
+        if target is not None:
+            deltas[target] += count
+        self.apply(category_id, deltas, advert_ids, user_id)
+
+
+class AdvertStatusCounter(models.Model):
+    category = models.ForeignKey(Category, verbose_name='Категория')
+    status = models.PositiveIntegerField(verbose_name='Статус', choices=options.ADVERT_STATUSES)
+    count = models.IntegerField(verbose_name='Количество', default=0)
+
+    objects = AdvertStatusCounterManager()
+
+    class Meta:
+        verbose_name = 'счётчик объявлений по статусу'
+        verbose_name_plural = 'счётчики объявлений по статусам'
+        unique_together = ('category', 'status')
+
+    def __str__(self):
+        return '{0}: {1}'.format(self.get_status_display(), self.count)
+
+
+class AdvertInWorkCounterManager(models.Manager):
+    def shift(self, category_id, user_id, delta):
+        counter, created = self.get_or_create(category_id=category_id, user_id=user_id, defaults={'count': delta})
+        if not created:
+            self.filter(pk=counter.pk).update(count=F('count') + delta)
+
+
+class AdvertInWorkCounter(models.Model):
+    category = models.ForeignKey(Category, verbose_name='Категория')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name='Пользователь', related_name='+')
+    count = models.IntegerField(verbose_name='Количество', default=0)
+
+    objects = AdvertInWorkCounterManager()
+
+    class Meta:
+        verbose_name = 'счётчик объявлений в работе'
+        verbose_name_plural = 'счётчики объявлений в работе'
+        unique_together = ('category', 'user')
+
+    def __str__(self):
+        return 'В работе у пользователя {0}: {1}'.format(self.user, self.count)
+
+
+class AdvertChangeEventManager(models.Manager):
+    poll_interval = getattr(settings, 'ADVERTS_CHANGES_POLL_INTERVAL', 0.5)
+    keep_hours = getattr(settings, 'ADVERTS_CHANGES_KEEP_HOURS', 24)
+
+    def get_signal_key(self, category_id):
+        return 'adverts_v2:changes:{0}:signal'.format(category_id)
+
+    def record(self, category_id, deltas, advert_ids=(), user_id=None):
+        # вызывается под блокировкой категории (AdvertStatusCounterManager.apply): следующая версия
+        # выдаётся только после коммита или отката предыдущей, поэтому версии идут без пропусков
+        event = self.create(
+            category_id=category_id,
+            version=self.get_version(category_id) + 1,
+            user_id=user_id,
+            advert_ids=list(advert_ids),
+            deltas=[[status, in_work_user_id, delta] for (status, in_work_user_id), delta in deltas.items() if delta],
+        )
+        # ожидающие клиенты смотрят только на счётчик в кеше, будим их после коммита
+        transaction.on_commit(lambda: self.notify(category_id), using=self.db)
+        return event
+
+    def notify(self, category_id):
+        key = self.get_signal_key(category_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            if not cache.add(key, 1, timeout=None):
+                cache.incr(key)
+
+    def get_signal(self, category_id):
+        return cache.get(self.get_signal_key(category_id), 0)
+
+    def get_version(self, category_id):
+        return self.filter(category_id=category_id).aggregate(version=Max('version'))['version'] or 0
+
+    def get_changes(self, category_id, since, limit=100):
+        """
+        События категории новее версии since по порядку -> (события, resync).
+        Пропуск перед первым событием значит, что отставшие события уже удалены, а версия больше
+        текущей - что клиент пришёл с чужой нумерацией; дельтам тогда верить нельзя (resync).
+        """
+        events = list(self.filter(category_id=category_id, version__gt=since).order_by('version')[:limit])
+        if events:
+            return events, events[0].version != since + 1
+        return events, since > self.get_version(category_id)
+
+    def wait(self, category_id, since, timeout):
+        """
+        Ждёт событий новее since не дольше timeout секунд -> (события, resync).
+        Пока ждём, база читается только после сигнала в кеше.
+        """
+        deadline = time.monotonic() + timeout
+        signal = None
+        while True:
+            current = self.get_signal(category_id)
+            if current != signal:
+                signal = current
+                events, resync = self.get_changes(category_id, since)
+                if events or resync:
+                    return events, resync
+            if time.monotonic() >= deadline:
+                return [], False
+            time.sleep(self.poll_interval)
+
+    def prune(self, keep_hours=None):
+        keep_hours = self.keep_hours if keep_hours is None else keep_hours
+        # последнее событие категории оставляем: по пропуску перед ним отставший клиент поймёт, что нужен resync
+        latest = Q()
+        for category_id, version in self.values_list('category').annotate(latest=Max('version')).order_by():
+            latest |= Q(category_id=category_id, version=version)
+        queryset = self.filter(created__lt=timezone.now() - timedelta(hours=keep_hours))
+        if latest:
+            queryset = queryset.exclude(latest)
+        return queryset.delete()[0]
+
+
+class AdvertChangeEvent(models.Model):
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='+')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name='Пользователь', related_name='+',
+                             null=True, blank=True)
+    # номер изменения внутри категории, без пропусков
+    version = models.PositiveIntegerField(verbose_name='Версия', default=0)
+    advert_ids = ArrayField(models.IntegerField(), verbose_name='Объявления', default=list)
+    # [статус, пользователь для "в работе", изменение]
+    deltas = JSONField(verbose_name='Изменения счётчиков', default=list)
+    created = models.DateTimeField(verbose_name='Дата', auto_now_add=True, db_index=True)
+
+    objects = AdvertChangeEventManager()
+
+    class Meta:
+        verbose_name = 'изменение объявлений'
+        verbose_name_plural = 'лента изменений объявлений'
+        unique_together = ('category', 'version')
+
+    def __str__(self):
+        return 'Изменение #{0} в категории {1}'.format(self.version, self.category_id)
+
+    def as_dict(self):
+        return {
+            'version': self.version,
+            'user': self.user_id,
+            'adverts': self.advert_ids,
+            'deltas': self.deltas,
+            'created': self.created.isoformat(),
+        }
+
+
+class AdvertMinHashManager(models.Manager):
+    def build(self, advert, signature=None):
+        if signature is None:
+            signature = get_text_signature(advert.title_original, advert.description_original)
+        if signature is None:
+            return None
+        return self.model(advert=advert, signature=signature, bands=get_bands(signature))
+
+    def index_adverts(self, adverts, min_similarity=DUPLICATE_SIMILARITY, signatures=None):
+        """
+        Индексирует объявления и помечает дубли объявлений других доноров.
+        Кандидаты ищутся одним запросом по пересечению полос LSH, сигнатуры сравниваются только у них.
+        signatures - заранее посчитанные сигнатуры в порядке adverts, чтобы не считать их здесь.
+        """
+        adverts = list(adverts)
+        signatures = [None] * len(adverts) if signatures is None else signatures
+        entries = [entry for entry in map(self.build, adverts, signatures) if entry is not None]
+        if not entries:
+            return []
+        self.filter(advert__in=adverts).delete()
+
+        buckets = {}
+
+        def register(entry, donor):
+            for band in entry.bands:
+                buckets.setdefault(band, []).append((entry, donor))
+
+        candidates = self.filter(
+            bands__overlap=sorted({band for entry in entries for band in entry.bands}),
+        ).annotate(advert_donor=F('advert__donor'))
+        for candidate in candidates:
+            register(candidate, candidate.advert_donor)
+
+        for entry in entries:
+            donor = entry.advert.donor
+            best, best_similarity = None, min_similarity
+            compared = set()
+            for band in entry.bands:
+                for candidate, candidate_donor in buckets.get(band, ()):
+                    if candidate_donor == donor or candidate.advert_id in compared:
+                        continue
+                    compared.add(candidate.advert_id)
+                    similarity = get_similarity(entry.signature, candidate.signature)
+                    if similarity >= best_similarity:
+                        best, best_similarity = candidate, similarity
+            if best is not None:
+                entry.duplicate_of_id = best.duplicate_of_id or best.advert_id
+            register(entry, donor)
+
+        self.bulk_create(entries)
+        return [entry for entry in entries if entry.duplicate_of_id]
+
+    def index_missing(self, chunk_size=1000):
+        queryset = Advert._base_manager.filter(minhash=None).only(
+            'id', 'donor', 'title_original', 'description_original').order_by('id')
+        last_id = count = 0
+        while True:
+            chunk = list(queryset.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                return count
+            entries = [entry for entry in map(self.build, chunk) if entry is not None]
+            self.bulk_create(entries)
+            count += len(entries)
+            last_id = chunk[-1].id
+
+    def iter_buckets(self, limit=DUPLICATE_BUCKET_LIMIT):
+        """Корзины LSH из базы: id объявлений с общей полосой, не больше limit самых старых в корзине."""
+        connection = connections[self.db]
+        sql = (
+            'SELECT (array_agg(advert_id ORDER BY advert_id))[1:%s] FROM {0}, unnest(bands) AS band '
+            'GROUP BY band HAVING count(*) > 1'
+        ).format(connection.ops.quote_name(self.model._meta.db_table))
+        # серверный курсор: корзины не копятся в памяти целиком
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(sql, [limit])
+            for advert_ids, in cursor:
+                yield advert_ids
+
+    def cluster_buckets(self, buckets, clusters, min_similarity=DUPLICATE_SIMILARITY,
+                        max_leaders=DUPLICATE_BUCKET_LEADERS):
+        """
+        Сравнивает сигнатуры внутри пачки корзин. Маленькие корзины сравниваются попарно,
+        в больших (шаблонные тексты) объявление сравнивается только с max_leaders представителями.
+        """
+        rows = self.filter(advert_id__in={advert_id for advert_ids in buckets for advert_id in advert_ids})
+        entries = {advert_id: (donor, signature) for advert_id, donor, signature
+                   in rows.values_list('advert_id', 'advert__donor', 'signature')}
+
+        for advert_ids in buckets:
+            pairwise = len(advert_ids) <= max_leaders
+            leaders = []
+            for advert_id in advert_ids:
+                if advert_id not in entries:
+                    continue
+                donor, signature = entries[advert_id]
+                matched = False
+                for leader_id in leaders:
+                    leader_donor, leader_signature = entries[leader_id]
+                    if leader_donor == donor or clusters.find(advert_id) == clusters.find(leader_id):
+                        continue
+                    if get_similarity(signature, leader_signature) >= min_similarity:
+                        clusters.union(advert_id, leader_id)
+                        matched = True
+                if (pairwise or not matched) and len(leaders) < max_leaders:
+                    leaders.append(advert_id)
+
+    def cluster(self, min_similarity=DUPLICATE_SIMILARITY, batch_size=5000):
+        """
+        Перестраивает кластеры дублей по всей таблице; корень кластера - самое старое объявление.
+        Корзины читаются потоком, сигнатуры подгружаются пачками только для объявлений из корзин.
+        """
+        clusters = UnionFind()
+        batch, batch_size_left = [], batch_size
+        for advert_ids in self.iter_buckets():
+            batch.append(advert_ids)
+            batch_size_left -= len(advert_ids)
+            if batch_size_left <= 0:
+                self.cluster_buckets(batch, clusters, min_similarity)
+                batch, batch_size_left = [], batch_size
+        if batch:
+            self.cluster_buckets(batch, clusters, min_similarity)
+
+        groups = [members for members in clusters.groups().values() if len(members) > 1]
+        with transaction.atomic():
+            self.exclude(duplicate_of=None).update(duplicate_of=None)
+            for members in groups:
+                root_id = min(members)
+                self.filter(advert_id__in=members).exclude(advert_id=root_id).update(duplicate_of_id=root_id)
+        return groups
+
+
+class AdvertMinHash(models.Model):
+    advert = models.OneToOneField(Advert, verbose_name='Объявление', related_name='minhash', primary_key=True)
+    signature = ArrayField(models.BigIntegerField(), verbose_name='Сигнатура MinHash')
+    bands = ArrayField(models.CharField(max_length=32), verbose_name='Полосы LSH')
+    duplicate_of = models.ForeignKey(Advert, verbose_name='Дубль объявления', related_name='+',
+                                     null=True, blank=True, on_delete=models.SET_NULL)
+
+    objects = AdvertMinHashManager()
+
+    class Meta:
+        verbose_name = 'сигнатура текста объявления'
+        verbose_name_plural = 'сигнатуры текстов объявлений'
+        indexes = [GinIndex(fields=['bands'], name='adverts_v2_minhash_bands_gin')]
+
+    def __str__(self):
+        return 'Сигнатура объявления #{0}'.format(self.advert_id)
+
+
+class ArchivedAdvertManager(models.Manager):
+    archive_after_days = getattr(settings, 'ADVERTS_ARCHIVE_AFTER_DAYS', 180)
+    archive_statuses = (options.USED, options.REJECTED)
+
+    def get_archivable_queryset(self, older_than=None, statuses=None):
+        older_than = self.archive_after_days if older_than is None else older_than
+        cutoff = timezone.now() - timedelta(days=older_than)
+        # возраст считаем от смены статуса; у старых строк без этой даты - от последнего изменения
+        return Advert._base_manager.filter(
+            Q(status_changed__lt=cutoff) | Q(status_changed=None, updated__lt=cutoff),
+            status__in=self.archive_statuses if statuses is None else statuses,
+        ).order_by('id')
+
+    def archive_chunk(self, queryset, chunk_size=500):
+        """
+        Переносит в архив одну пачку объявлений вместе с фото и отметкой о работе.
+        Пачка переносится целиком в одной транзакции, поэтому прерванный перенос
+        можно просто запустить заново - перенесённые строки в выборку уже не попадут.
+        """
+        with transaction.atomic():
+            advert_ids = list(queryset.select_for_update(skip_locked=True).values_list('id', flat=True)[:chunk_size])
+            if not advert_ids:
+                return 0
+
+            adverts = list(Advert.objects.filter(pk__in=advert_ids).prefetch_related('photos').order_by('id'))
+            in_work = dict(AdvertInWork.objects.filter(advert_id__in=advert_ids).values_list('advert_id', 'user_id'))
+
+            deltas = {}
+            category_advert_ids = {}
+            archived = []
+            photos = []
+            for advert in adverts:
+                in_work_user_id = in_work.get(advert.pk)
+                bucket = advert.get_counter_bucket(in_work_user_id)
+                if bucket is not None:
+                    category_deltas = deltas.setdefault(advert.category_id, Counter())
+                    category_deltas[bucket] -= 1
+                    category_advert_ids.setdefault(advert.category_id, []).append(advert.pk)
+
+                archived.append(self.model.from_advert(advert, in_work_user_id))
+                photos.extend(ArchivedAdvertPhoto.from_photo(photo) for photo in advert.photos.all())
+
+            self.bulk_create(archived)
+            ArchivedAdvertPhoto.objects.bulk_create(photos)
+            for category_id, category_deltas in deltas.items():
+                AdvertStatusCounter.objects.apply(category_id, category_deltas,
+                                                  advert_ids=category_advert_ids[category_id])
+
+            # каскадом уходят строки подклассов, фото, отметки о работе и сигнатуры текстов; файлы фото остаются
+            Advert._base_manager.filter(pk__in=advert_ids).delete()
+        return len(advert_ids)
+
+    def archive(self, older_than=None, statuses=None, chunk_size=500):
+        queryset = self.get_archivable_queryset(older_than, statuses)
+        while True:
+            count = self.archive_chunk(queryset, chunk_size)
+            if not count:
+                return
+            yield count
+
+
+class ArchivedAdvert(models.Model):
+    id = models.IntegerField(verbose_name='ID объявления', primary_key=True)
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='+')
+    model_name = models.CharField(verbose_name='Модель', max_length=100)
+    status = models.PositiveIntegerField(verbose_name='Статус', choices=options.ADVERT_STATUSES)
+
+    donor = models.PositiveSmallIntegerField(verbose_name='Донор', choices=options.DONORS)
+    donor_url = models.URLField(verbose_name='Урл объявления', unique=True)
+    in_work_user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name='Был в работе у', related_name='+',
+                                     null=True, blank=True)
+    data = JSONField(verbose_name='Поля объявления', encoder=DjangoJSONEncoder)
+
+    created = models.DateTimeField(verbose_name='Дата добавления')
+    updated = models.DateTimeField(verbose_name='Дата изменения')
+    archived = models.DateTimeField(verbose_name='Дата архивации', auto_now_add=True)
+
+    objects = ArchivedAdvertManager()
+
+    class Meta:
+        verbose_name = 'архивное объявление'
+        verbose_name_plural = 'архивные объявления'
+
+    def __str__(self):
+        return 'Архивное объявление #{0}'.format(self.id)
+
+    @classmethod
+    def from_advert(cls, advert, in_work_user_id=None):
+        data = {
+            field.attname: getattr(advert, field.attname)
+            for field in advert._meta.concrete_fields
+            if not field.primary_key and field.name != 'search_vector'
+        }
+        return cls(id=advert.pk, category_id=advert.category_id, model_name=advert._meta.model_name,
+                   status=advert.status, donor=advert.donor, donor_url=advert.donor_url,
+                   in_work_user_id=in_work_user_id, data=data, created=advert.created, updated=advert.updated)
+
+
+class ArchivedAdvertPhoto(models.Model):
+    advert = models.ForeignKey(ArchivedAdvert, verbose_name='Объявление', related_name='photos')
+    image = models.CharField(verbose_name='Фото', max_length=255)
+    checksum = models.CharField(verbose_name='Контрольная сумма', max_length=100)
+    enabled = models.BooleanField(verbose_name='Активна', default=True)
+    is_main = models.BooleanField(verbose_name='Главная', default=False)
+    phash = models.BigIntegerField(verbose_name='Перцептивный хеш', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'фото к архивному объявлению'
+        verbose_name_plural = 'фото к архивным объявлениям'
+
+    def __str__(self):
+        return 'Фото к архивному объявлению #{0}'.format(self.advert_id)
+
+    @classmethod
+    def from_photo(cls, photo):
+        return cls(advert_id=photo.advert_id, image=photo.image.name, checksum=photo.checksum,
+                   enabled=photo.enabled, is_main=photo.is_main, phash=photo.phash)
+
+
+class TextRegenerationJobManager(models.Manager):
+    def get_or_start(self, category, field, restart=False):
+        # незавершённая задача по той же категории и полю продолжается с места остановки
+        job = self.filter(category=category, field=field).exclude(status=self.model.DONE).order_by('-id').first()
+        if job is not None and restart:
+            job.status = self.model.FAILED
+            job.save(update_fields=('status', 'updated'))
+            job = None
+        if job is None:
+            job = self.create(category=category, field=field)
+        return job
+
+
+class TextRegenerationJob(models.Model):
+    PENDING, RUNNING, DONE, FAILED = range(4)
+    STATUSES = (
+        (PENDING, 'Ожидает'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Завершена'),
+        (FAILED, 'Прервана'),
+    )
+
+    category = models.ForeignKey(Category, verbose_name='Категория')
+    field = models.CharField(verbose_name='Поле', max_length=100)
+    status = models.PositiveSmallIntegerField(verbose_name='Статус', choices=STATUSES, default=PENDING)
+
+    last_id = models.IntegerField(verbose_name='Последнее обработанное объявление', default=0)
+    processed = models.PositiveIntegerField(verbose_name='Обработано', default=0)
+    total = models.PositiveIntegerField(verbose_name='Всего', default=0)
+    error = models.TextField(verbose_name='Ошибка', blank=True)
+
+    created = models.DateTimeField(verbose_name='Дата создания', auto_now_add=True)
+    updated = models.DateTimeField(verbose_name='Дата изменения', auto_now=True)
+
+    objects = TextRegenerationJobManager()
+
+    class Meta:
+        verbose_name = 'перегенерация текстов'
+        verbose_name_plural = 'перегенерации текстов'
+
+    def __str__(self):
+        return 'Перегенерация поля {0} в категории {1}'.format(self.field, self.category.title)
+
+    @property
+    def progress(self):
+        return round(100 * self.processed / self.total, 1) if self.total else 0
+
+
 class ApartmentAdvert(Advert):
     street = ChainedForeignKey(Street, verbose_name='Улица', chained_field='district', chained_model_field='district',
                                auto_choose=True, blank=True, null=True)
     house_number = models.CharField(verbose_name='Номер дома', max_length=30, blank=True)
+    address_normalized = models.CharField(verbose_name='Нормализованный адрес', max_length=255, blank=True,
+                                          db_index=True, editable=False)
 
     house_material = models.PositiveSmallIntegerField(verbose_name='Материал дома', choices=options.HOUSE_MATERIALS,
                                                       null=True, blank=True)
@@ -262,14 +1152,18 @@ class ApartmentAdvert(Advert):
     has_tv = models.BooleanField(verbose_name='С телевизором', default=False)
     has_internet = models.BooleanField(verbose_name='С интернетом', default=False)
 
+    list_related_fields = Advert.list_related_fields + ('street', )
+
     class Meta:
         verbose_name = 'объявление о сдаче квартиры'
         verbose_name_plural = 'объявления в сдаче квартир'
 
-    def save(self, *args, **kwargs):
+    def populate_defaults(self, pool=None):
+        address = self.address
         if not self.title:
-            self.title = self.address
-        super().save(*args, **kwargs)
+            self.title = address
+        self.address_normalized = normalize_address(address)[:255]
+        super().populate_defaults(pool=pool)
 
     @property
     def apartment_type_value(self):
@@ -345,15 +1239,26 @@ class ApartmentAdvert(Advert):
         if self.created:
             yield 'Счётчик жизни объявления', '{} дн.'.format(self.days_count)
 
+    def get_geo_title(self, name, model):
+        # в списке объект уже подтянут через select_related (for_list), иначе берём название из справочника
+        field = self._meta.get_field(name)
+        if hasattr(self, field.get_cache_name()):
+            related = getattr(self, name)
+            return related.title if related is not None else None
+        return geo_references.get_title(model, getattr(self, field.attname))
+
     @property
     def address(self):
         address = ''
-        if self.city:
-            address += 'г. {}'.format(self.city.title)
-            if self.district:
-                address += ', {} р-н'.format(self.district.title)
-                if self.street:
-                    address += ', {}'.format(self.street.title)
+        city = self.get_geo_title('city', City)
+        if city:
+            address += 'г. {}'.format(city)
+            district = self.get_geo_title('district', District)
+            if district:
+                address += ', {} р-н'.format(district)
+                street = self.get_geo_title('street', Street)
+                if street:
+                    address += ', {}'.format(street)
                     if self.house_number:
                         address += ' {}'.format(self.house_number)
         return address
@@ -0,0 +1,91 @@
+from collections.abc import Sequence
+
+from django.core import signing
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+NEXT = 'next'
+PREVIOUS = 'previous'
+
+
+class CursorPage(Sequence):
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return '<CursorPage: {0} items>'.format(len(self))
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """
+    Постраничный вывод по ключу (created, id) без OFFSET и COUNT(*).
+    Курсоры подписаны, поэтому для клиента они непрозрачны и не подделываются.
+    """
+    salt = 'adverts_v2.pagination.cursor'
+
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+
+    def encode_cursor(self, obj, direction):
+        return signing.dumps([obj.created.isoformat(), obj.id, direction], salt=self.salt, compress=True)
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            created, pk, direction = signing.loads(cursor, salt=self.salt)
+        except (signing.BadSignature, TypeError, ValueError):
+            return None
+
+        created = parse_datetime(created)
+        if created is None or direction not in (NEXT, PREVIOUS):
+            return None
+        return created, pk, direction
+
+    def page(self, cursor=None):
+        position = self.decode_cursor(cursor)
+        if position is None:
+            items = list(self.queryset.order_by('created', 'id')[:self.per_page + 1])
+            has_more = len(items) > self.per_page
+            items = items[:self.per_page]
+            return CursorPage(items, next_cursor=self.encode_cursor(items[-1], NEXT) if has_more else None)
+
+        created, pk, direction = position
+        if direction == NEXT:
+            queryset = self.queryset.filter(Q(created__gt=created) | Q(created=created, id__gt=pk))
+            items = list(queryset.order_by('created', 'id')[:self.per_page + 1])
+            has_more = len(items) > self.per_page
+            items = items[:self.per_page]
+            return CursorPage(
+                items,
+                next_cursor=self.encode_cursor(items[-1], NEXT) if has_more else None,
+                previous_cursor=self.encode_cursor(items[0], PREVIOUS) if items else None,
+            )
+
+        queryset = self.queryset.filter(Q(created__lt=created) | Q(created=created, id__lt=pk))
+        items = list(queryset.order_by('-created', '-id')[:self.per_page + 1])
+        has_more = len(items) > self.per_page
+        items = items[:self.per_page][::-1]
+        return CursorPage(
+            items,
+            next_cursor=self.encode_cursor(items[-1], NEXT) if items else None,
+            previous_cursor=self.encode_cursor(items[0], PREVIOUS) if has_more else None,
+        )
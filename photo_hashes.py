@@ -0,0 +1,112 @@
+import threading
+
+from django.conf import settings
+from PIL import Image
+
+from .caches import VersionedLocalCache
+
+HASH_SIZE = 8
+DUPLICATE_DISTANCE = getattr(settings, 'ADVERTS_PHOTO_DUPLICATE_DISTANCE', 6)
+
+
+def dhash(source, size=HASH_SIZE):
+    """
+    Разностный хеш (dHash): 64 бита, устойчив к масштабированию и пережатию JPEG.
+    source - путь или файловый объект.
+    """
+    image = Image.open(source)
+    image.draft('L', ((size + 1) * 4, size * 4))
+    pixels = list(image.convert('L').resize((size + 1, size), Image.ANTIALIAS).getdata())
+
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for column in range(size):
+            value = (value << 1) | (pixels[offset + column] > pixels[offset + column + 1])
+    return to_signed(value)
+
+
+def to_signed(value):
+    # BigIntegerField знаковый, храним 64 бита в дополнительном коде
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def hamming(first, second):
+    return bin((first ^ second) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+
+class BKTree:
+    """
+    BK-дерево по расстоянию Хэмминга: поиск соседей в радиусе k обходит только часть узлов.
+    Узел - список [хеш, элементы, {расстояние: потомок}].
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(found, key=lambda pair: pair[0])
+
+
+class PhotoHashIndex:
+    """
+    Индекс хешей фото в памяти процесса. Новые фото догружаются по возрастанию id,
+    полная перестройка - после сброса версии (например, после заполнения хешей у старых фото).
+    """
+
+    def __init__(self):
+        self.cache = VersionedLocalCache('photo_hashes')
+        self._lock = threading.Lock()
+
+    def build_state(self):
+        return {'tree': BKTree(), 'last_id': 0}
+
+    def get_tree(self):
+        from apps.adverts_v2.models import AdvertPhoto
+
+        state = self.cache.get('state', self.build_state)
+        with self._lock:
+            rows = AdvertPhoto.objects.filter(id__gt=state['last_id'], phash__isnull=False).order_by('id')
+            for pk, phash in rows.values_list('id', 'phash').iterator():
+                state['tree'].add(phash, pk)
+                state['last_id'] = pk
+        return state['tree']
+
+    def search(self, value, max_distance=DUPLICATE_DISTANCE):
+        tree = self.get_tree()
+        # обход под той же блокировкой, что и догрузка: иначе словарь потомков меняется во время итерации
+        with self._lock:
+            return tree.search(value, max_distance)
+
+    def invalidate(self):
+        self.cache.invalidate()
+
+
+photo_hash_index = PhotoHashIndex()
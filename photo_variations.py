@@ -0,0 +1,76 @@
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+from libs.stdimage import ACTION_CROP
+from . import options
+
+PHOTO_VARIATIONS = {
+    'small': dict(
+        size=options.ADVERTS_PHOTOS_SMALL_SIZE,
+        action=ACTION_CROP,
+    ),
+    'admin_thumbnail': dict(alias_for='small'),
+}
+
+# ленивый режим включается явно: image.small.url в шаблонах и админке ждёт готовый файл
+LAZY_VARIATIONS = getattr(settings, 'ADVERTS_PHOTOS_LAZY_VARIATIONS', False)
+
+
+def render_variations_on_save(file_name, variations, storage, **kwargs):
+    # при ленивом режиме StdImage не рендерит вариации при сохранении фото
+    return not LAZY_VARIATIONS
+
+
+def resolve_variation(variation_name):
+    variation = PHOTO_VARIATIONS[variation_name]
+    while 'alias_for' in variation:
+        variation_name = variation['alias_for']
+        variation = PHOTO_VARIATIONS[variation_name]
+    return variation_name, variation
+
+
+def get_variation_name(file_name, variation_name):
+    # та же схема имён, что и у StdImage: <имя>.<вариация><расширение>
+    base, extension = os.path.splitext(file_name)
+    return '{0}.{1}{2}'.format(base, variation_name, extension)
+
+
+def render_variation(file_name, variation_name, storage, replace=False):
+    variation_name, variation = resolve_variation(variation_name)
+    target_name = get_variation_name(file_name, variation_name)
+    if not replace and storage.exists(target_name):
+        return target_name
+
+    with storage.open(file_name) as source:
+        image = Image.open(source)
+        image.load()
+
+    image_format = image.format or 'JPEG'
+    if image_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    if variation.get('action') == ACTION_CROP:
+        image = ImageOps.fit(image, variation['size'], Image.ANTIALIAS)
+    else:
+        image.thumbnail(variation['size'], Image.ANTIALIAS)
+
+    output = io.BytesIO()
+    image.save(output, image_format, quality=90)
+    if storage.exists(target_name):
+        storage.delete(target_name)
+    storage.save(target_name, ContentFile(output.getvalue()))
+    return target_name
+
+
+def render_all_variations(file_name, replace=False):
+    from apps.adverts_v2.models import AdvertPhoto
+
+    storage = AdvertPhoto._meta.get_field('image').storage
+    rendered = []
+    for variation_name, variation in PHOTO_VARIATIONS.items():
+        if 'alias_for' not in variation:
+            rendered.append(render_variation(file_name, variation_name, storage, replace=replace))
+    return rendered
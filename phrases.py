@@ -0,0 +1,98 @@
+from bisect import bisect_right
+from itertools import accumulate
+from random import random
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from apps.adverts_generator_v2.models import PhraseGroupSet
+from .caches import VersionedLocalCache
+
+
+def weighted_choice(items, cum_weights):
+    if not items:
+        return None
+    return items[bisect_right(cum_weights, random() * cum_weights[-1])]
+
+
+class PhraseGroupSetPool:
+    """
+    Заранее загруженные наборы фраз для массовой генерации: выбор идёт целиком в памяти.
+    """
+
+    def __init__(self, groupsets, weight_field=None):
+        index = {}
+        for groupset in groupsets:
+            weight = getattr(groupset, weight_field) if weight_field else 1
+            if weight and weight > 0:
+                items, weights = index.setdefault((groupset.category_id, groupset.advert_field), ([], []))
+                items.append(groupset)
+                weights.append(weight)
+        self.index = {key: (items, list(accumulate(weights))) for key, (items, weights) in index.items()}
+
+    def pick(self, category_id, advert_field):
+        return weighted_choice(*self.index.get((category_id, advert_field), ((), ())))
+
+
+class PhraseGroupSetPicker:
+    """
+    Случайный выбор набора фраз без ORDER BY RANDOM(): в памяти держим только
+    идентификаторы наборов для пары (категория, поле), а из базы забираем одну строку по pk.
+    Если у набора есть поле weight, выбор идёт с учётом веса.
+    """
+    weight_field = 'weight'
+
+    def __init__(self):
+        self.cache = VersionedLocalCache('phrase_groupsets')
+
+    def has_weights(self):
+        return any(field.name == self.weight_field for field in PhraseGroupSet._meta.get_fields())
+
+    def build_index(self, category_id, advert_field):
+        queryset = PhraseGroupSet.objects.filter(category_id=category_id, advert_field=advert_field).order_by('id')
+        if self.has_weights():
+            rows = queryset.values_list('id', self.weight_field)
+        else:
+            rows = ((pk, 1) for pk in queryset.values_list('id', flat=True))
+
+        ids, weights = [], []
+        for pk, weight in rows:
+            if weight and weight > 0:
+                ids.append(pk)
+                weights.append(weight)
+        return ids, list(accumulate(weights))
+
+    def get_index(self, category_id, advert_field):
+        return self.cache.get((category_id, advert_field), lambda: self.build_index(category_id, advert_field))
+
+    def choose_id(self, category_id, advert_field):
+        return weighted_choice(*self.get_index(category_id, advert_field))
+
+    def pick(self, category_id, advert_field):
+        pk = self.choose_id(category_id, advert_field)
+        if pk is None:
+            return None
+
+        groupset = PhraseGroupSet.objects.filter(pk=pk).first()
+        if groupset is None:
+            # набор удалили, а индекс этого процесса ещё не сброшен
+            self.cache.invalidate()
+            pk = self.choose_id(category_id, advert_field)
+            groupset = PhraseGroupSet.objects.filter(pk=pk).first() if pk is not None else None
+        return groupset
+
+    def load_pool(self, category_ids, advert_fields):
+        groupsets = PhraseGroupSet.objects.filter(category_id__in=category_ids, advert_field__in=advert_fields)
+        return PhraseGroupSetPool(groupsets.order_by('id'), self.weight_field if self.has_weights() else None)
+
+    def invalidate(self):
+        self.cache.invalidate()
+
+
+phrase_groupsets = PhraseGroupSetPicker()
+
+
+@receiver(post_save, sender=PhraseGroupSet)
+@receiver(post_delete, sender=PhraseGroupSet)
+def invalidate_phrase_groupsets(sender, **kwargs):
+    phrase_groupsets.invalidate()
@@ -0,0 +1,122 @@
+import logging
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import connections, transaction
+from django.db.models import Case, When, Value, TextField
+from django.utils import timezone
+
+from . import options
+from .phrases import phrase_groupsets
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_inherited_connections = []
+
+
+def detach_inherited_connections():
+    # унаследованный после fork сокет закрывать нельзя: Terminate уйдёт в сессию родителя.
+    # Просто забываем его (и держим ссылку, чтобы сборщик мусора не закрыл), воркер откроет своё соединение
+    for connection in connections.all():
+        if connection.connection is not None:
+            _inherited_connections.append(connection.connection)
+            connection.connection = None
+
+
+def init_worker(category_id, field):
+    global _pool
+    detach_inherited_connections()
+    _pool = phrase_groupsets.load_pool([category_id], [field])
+
+
+def start_workers():
+    return os.getpid()
+
+
+def generate_chunk(adverts, field):
+    return [(advert.pk, advert.generate_text(field, exists_check=False, pool=_pool)) for advert in adverts]
+
+
+class TextRegenerator:
+    """
+    Массовая перегенерация одного поля объявлений категории.
+    Объявления идут пачками по возрастанию id, тексты генерируют процессы-воркеры,
+    запись - одним UPDATE ... CASE на пачку вместе с прогрессом задачи, поэтому
+    после падения задача продолжается с last_id. Объявления в работе не трогаем.
+    """
+
+    def __init__(self, job, chunk_size=200, workers=None):
+        if job.field not in options.AUTO_GENERATED_FIELDS:
+            raise ValueError('Field {} is not enabled for text generation'.format(job.field))
+        self.job = job
+        self.chunk_size = chunk_size
+        self.workers = workers or os.cpu_count() or 1
+        self.model = job.category.get_model()
+
+    def get_queryset(self):
+        return self.job.category.get_adverts_queryset().filter(advertinwork=None).for_list().order_by('id')
+
+    def iter_chunks(self):
+        queryset = self.get_queryset()
+        last_id = self.job.last_id
+        while True:
+            chunk = list(queryset.filter(id__gt=last_id)[:self.chunk_size])
+            if not chunk:
+                return
+            last_id = chunk[-1].pk
+            yield chunk
+
+    def write_chunk(self, texts, last_id):
+        field = self.job.field
+        with transaction.atomic():
+            advert_ids = [pk for pk, text in texts]
+            self.model._base_manager.filter(pk__in=advert_ids).update(**{
+                field: Case(*[When(pk=pk, then=Value(text)) for pk, text in texts], output_field=TextField()),
+                'updated': timezone.now(),
+            })
+            self.model.objects.get_model_queryset(self.model).filter(pk__in=advert_ids).update_search_vectors()
+
+            self.job.last_id = last_id
+            self.job.processed += len(texts)
+            self.job.save(update_fields=('last_id', 'processed', 'updated'))
+
+    def run(self, progress=None):
+        job = self.job
+        job.total = job.processed + self.get_queryset().filter(id__gt=job.last_id).count()
+        job.status = job.RUNNING
+        job.save(update_fields=('status', 'total', 'updated'))
+
+        try:
+            # воркеры создаются при первой задаче: запускаем их сразу после закрытия соединений,
+            # до первого запроса родителя, чтобы они не унаследовали открытый сокет
+            connections.close_all()
+            with ProcessPoolExecutor(self.workers, initializer=init_worker,
+                                     initargs=(job.category_id, job.field)) as executor:
+                executor.submit(start_workers).result()
+                pending = deque()
+                max_pending = self.workers * 2
+                for chunk in self.iter_chunks():
+                    pending.append((executor.submit(generate_chunk, chunk, job.field), chunk[-1].pk))
+                    # пишем строго по порядку пачек, чтобы last_id не перескакивал через незаписанные
+                    while len(pending) >= max_pending or pending and pending[0][0].done():
+                        self.finish_chunk(pending.popleft(), progress)
+                while pending:
+                    self.finish_chunk(pending.popleft(), progress)
+        except BaseException as error:
+            job.status = job.FAILED
+            job.error = repr(error)
+            job.save(update_fields=('status', 'error', 'updated'))
+            raise
+
+        job.status = job.DONE
+        job.save(update_fields=('status', 'updated'))
+        return job
+
+    def finish_chunk(self, item, progress):
+        future, last_id = item
+        self.write_chunk(future.result(), last_id)
+        logger.info('%s: %s/%s', self.job, self.job.processed, self.job.total)
+        if progress is not None:
+            progress(self.job)
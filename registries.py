@@ -0,0 +1,64 @@
+import threading
+from collections import namedtuple
+
+from django.core.signals import request_started
+from django.db.models.signals import post_save, post_delete
+
+from apps.adverts_v2.forms import modelform_fabric
+from libs.utils import import_by_name
+from . import options
+from .caches import VersionedLocalCache
+
+CategoryClasses = namedtuple('CategoryClasses', ('form_class', 'builder_class'))
+
+
+class CategoryClassesRegistry:
+    """
+    Классы формы и сборщика архива для категорий, собранные один раз на процесс.
+    Ключ - (model_name, builder_class_name); при изменении любой категории реестр сбрасывается.
+    """
+
+    def __init__(self):
+        self.cache = VersionedLocalCache('category_classes')
+        self._warmed_up = False
+        self._lock = threading.Lock()
+
+    def build(self, category):
+        return CategoryClasses(
+            form_class=modelform_fabric(model=category.get_model()),
+            builder_class=import_by_name(name=category.builder_class_name, module=options.ARCHIVE_BUILDERS_MODULE),
+        )
+
+    def get(self, category):
+        return self.cache.get((category.model_name, category.builder_class_name), lambda: self.build(category))
+
+    def invalidate(self):
+        self.cache.invalidate()
+
+    def warm_up(self):
+        from apps.adverts_v2.models import Category
+
+        with self._lock:
+            if self._warmed_up:
+                return
+            self._warmed_up = True
+
+        for category in Category.objects.all():
+            self.get(category)
+
+
+category_classes = CategoryClassesRegistry()
+
+
+def invalidate_category_classes(sender, **kwargs):
+    category_classes.invalidate()
+
+
+def warm_up_category_classes(sender, **kwargs):
+    request_started.disconnect(warm_up_category_classes)
+    category_classes.warm_up()
+
+
+post_save.connect(invalidate_category_classes, sender='adverts_v2.Category')
+post_delete.connect(invalidate_category_classes, sender='adverts_v2.Category')
+request_started.connect(warm_up_category_classes)
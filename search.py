@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank, TrigramSimilarity
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.dispatch import receiver
+
+SEARCH_CONFIG = getattr(settings, 'ADVERTS_SEARCH_CONFIG', 'russian')
+TRIGRAM_THRESHOLD = getattr(settings, 'ADVERTS_SEARCH_TRIGRAM_THRESHOLD', 0.3)
+
+# поле -> вес в поисковом векторе
+SEARCH_FIELDS = (
+    ('title', 'A'),
+    ('title_original', 'B'),
+    ('description', 'C'),
+    ('description_original', 'D'),
+)
+SEARCH_FIELD_NAMES = frozenset(name for name, weight in SEARCH_FIELDS)
+
+
+@receiver(connection_created)
+def set_trigram_threshold(sender, connection, **kwargs):
+    # порог оператора %: с ним фильтр по триграммам идёт по индексу gin_trgm_ops
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SET pg_trgm.similarity_threshold = %s', [TRIGRAM_THRESHOLD])
+
+
+def get_search_vector():
+    vector = None
+    for name, weight in SEARCH_FIELDS:
+        field_vector = SearchVector(name, weight=weight, config=SEARCH_CONFIG)
+        vector = field_vector if vector is None else vector + field_vector
+    return vector
+
+
+def search_queryset(queryset, query):
+    """
+    Полнотекстовый поиск с русской морфологией по индексу search_vector.
+    Если ничего не нашлось (опечатка, часть слова) - нечёткий поиск по триграммам заголовка.
+    """
+    search_query = SearchQuery(query, config=SEARCH_CONFIG)
+    found = queryset.filter(search_vector=search_query).annotate(
+        search_rank=SearchRank(F('search_vector'), search_query),
+    ).order_by('-search_rank', '-created', '-id')
+    if found.exists():
+        return found
+
+    # similarity() только для сортировки, отбор - индексируемым оператором %
+    return queryset.filter(title__trigram_similar=query).annotate(
+        search_rank=TrigramSimilarity('title', query),
+    ).order_by('-search_rank', '-created', '-id')
@@ -0,0 +1,91 @@
+import hashlib
+import mmap
+import os
+import tempfile
+from array import array
+from bisect import bisect_left
+from itertools import chain
+
+from django.conf import settings
+
+SEEN_SET_PATH = getattr(settings, 'ADVERTS_DONOR_SEEN_SET_PATH',
+                        os.path.join(tempfile.gettempdir(), 'adverts_v2_donor_urls.seen'))
+
+
+def get_url_hash(donor, url):
+    digest = hashlib.blake2b('{0}:{1}'.format(donor, url).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def write_seen_set(hashes, path=SEEN_SET_PATH):
+    """Пишет отсортированный массив 64-битных хешей; файл подменяется атомарно."""
+    data = array('Q', sorted(set(hashes)))
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as seen_file:
+            data.tofile(seen_file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(data)
+
+
+def rebuild_seen_set(path=SEEN_SET_PATH):
+    from apps.adverts_v2.models import Advert, ArchivedAdvert
+
+    rows = chain(Advert._base_manager.values_list('donor', 'donor_url').iterator(),
+                 ArchivedAdvert.objects.values_list('donor', 'donor_url').iterator())
+    return write_seen_set((get_url_hash(donor, url) for donor, url in rows), path)
+
+
+class DonorSeenSet:
+    """
+    Множество уже собранных (donor, donor_url): отсортированный файл хешей,
+    открытый через mmap, и бинарный поиск по нему. Ссылки, записанные после
+    перестроения файла, держатся в памяти процесса.
+    """
+
+    def __init__(self, path=SEEN_SET_PATH):
+        self.path = path
+        self._file = None
+        self._mmap = None
+        self._hashes = ()
+        self._added = set()
+
+    def open(self):
+        if not os.path.exists(self.path) or not os.path.getsize(self.path):
+            return self
+        self._file = open(self.path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._hashes = memoryview(self._mmap).cast('Q')
+        return self
+
+    def close(self):
+        if self._mmap is not None:
+            self._hashes.release()
+            self._mmap.close()
+            self._file.close()
+        self._file = self._mmap = None
+        self._hashes = ()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._hashes) + len(self._added)
+
+    def contains(self, donor, url):
+        url_hash = get_url_hash(donor, url)
+        if url_hash in self._added:
+            return True
+        index = bisect_left(self._hashes, url_hash)
+        return index < len(self._hashes) and self._hashes[index] == url_hash
+
+    def add(self, donor, url):
+        self._added.add(get_url_hash(donor, url))
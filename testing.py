@@ -0,0 +1,64 @@
+import uuid
+from contextlib import contextmanager
+
+from . import options
+from .instrumentation import QueryRecorder
+
+
+def format_report(recorder, max_queries):
+    lines = ['{0}: {1} queries, budget {2}'.format(recorder.name, recorder.queries, max_queries)]
+    for name, stats in sorted(recorder.sections.items()):
+        lines.append('  {0}: {1} queries, {2:.1f} ms'.format(name, stats['queries'], stats['db_time'] * 1000))
+    lines.append('slowest:')
+    for query in recorder.slowest:
+        lines.append('  {0:.1f} ms [{1}] {2}'.format(query['time'] * 1000, query['section'], query['sql']))
+        lines.extend('    {0}'.format(call_site) for call_site in query['call_site'])
+    return '\n'.join(lines)
+
+
+@contextmanager
+def query_budget(max_queries, name='block'):
+    """Падает с AssertionError и разбивкой по секциям, если блок сделал больше max_queries запросов."""
+    with QueryRecorder(name) as recorder:
+        yield recorder
+    if recorder.queries > max_queries:
+        raise AssertionError(format_report(recorder, max_queries))
+
+
+def assert_view_budget(client, url, max_queries, method='get', ajax=False, **kwargs):
+    if ajax:
+        kwargs['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+    with query_budget(max_queries, url):
+        response = getattr(client, method)(url, **kwargs)
+    return response
+
+
+def seed_adverts(category, count=50, photos=3, in_work_user=None, in_work_count=0):
+    """
+    Набор данных для проверки бюджетов: объявления категории с фото и отметками о работе.
+    Количество запросов во вьюхах не должно зависеть от count.
+    """
+    from apps.adverts_v2.models import Advert, AdvertPhoto, AdvertInWork, AdvertStatusCounter
+
+    model = category.get_model()
+    adverts = Advert.objects.bulk_create_adverts(
+        model(
+            category=category,
+            donor=options.DUMMY,
+            donor_url=options.DUMMY_URL.format(uuid.uuid4()),
+            title='Объявление {0}'.format(index),
+            description='Описание объявления {0}'.format(index),
+            price=1000 * (index + 1),
+        )
+        for index in range(count)
+    )
+    AdvertPhoto.objects.bulk_create(
+        AdvertPhoto(advert=advert, image='seed/{0}.jpg'.format(uuid.uuid4()), checksum=uuid.uuid4().hex,
+                    is_main=not index)
+        for advert in adverts for index in range(photos)
+    )
+    if in_work_user is not None:
+        AdvertInWork.objects.bulk_create(AdvertInWork(advert=advert, user=in_work_user)
+                                         for advert in adverts[:in_work_count])
+    AdvertStatusCounter.objects.rebuild(category)
+    return adverts
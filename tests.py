@@ -0,0 +1,143 @@
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, RequestFactory
+
+from apps.adverts_v2 import options
+from apps.adverts_v2.models import Category, Advert, ApartmentAdvert, AdvertStatusCounter, AdvertInWorkCounter
+from apps.adverts_v2.views import work_complete
+
+
+class AdvertsTestMixin:
+    def setUp(self):
+        self.category = Category.objects.create(title='Квартиры', alias='apartments', model_name='apartmentadvert')
+
+    def build_adverts(self, count):
+        return [
+            ApartmentAdvert(category=self.category, donor=options.DUMMY,
+                            donor_url=options.DUMMY_URL.format(uuid.uuid4()), title='Квартира {0}'.format(index),
+                            rooms_number=index + 1)
+            for index in range(count)
+        ]
+
+
+class BulkCreateAdvertsTest(AdvertsTestMixin, TestCase):
+
+    def test_subclass_rows_point_to_parent_rows(self):
+        adverts = ApartmentAdvert.objects.bulk_create_adverts(self.build_adverts(3))
+
+        self.assertTrue(all(advert.pk is not None and advert.pk == advert.id for advert in adverts))
+        self.assertEqual(ApartmentAdvert.objects.count(), 3)
+        self.assertEqual(
+            sorted(ApartmentAdvert._base_manager.values_list('advert_ptr_id', 'rooms_number')),
+            sorted((advert.id, advert.rooms_number) for advert in adverts),
+        )
+        self.assertEqual(
+            set(Advert.objects.get_category_queryset(category=self.category).values_list('id', flat=True)),
+            {advert.id for advert in adverts},
+        )
+
+    def test_counters_are_updated(self):
+        AdvertStatusCounter.objects.rebuild(self.category)
+        ApartmentAdvert.objects.bulk_create_adverts(self.build_adverts(2))
+
+        self.assertEqual(AdvertStatusCounter.objects.get(category=self.category, status=options.NEW).count, 2)
+
+
+class AdvertStatusCountersTest(AdvertsTestMixin, TestCase):
+    """Счётчики после каждого перехода должны совпадать с пересчётом с нуля."""
+
+    def setUp(self):
+        super().setUp()
+        User = get_user_model()
+        self.user = User.objects.create_user(username='operator', password='operator')
+        self.other_user = User.objects.create_user(username='other', password='other')
+        self.adverts = ApartmentAdvert.objects.bulk_create_adverts(self.build_adverts(5))
+        AdvertStatusCounter.objects.rebuild(self.category)
+
+    def get_counters(self):
+        statuses = dict(AdvertStatusCounter.objects.filter(category=self.category).exclude(count=0)
+                        .values_list('status', 'count'))
+        in_work = dict(AdvertInWorkCounter.objects.filter(category=self.category).exclude(count=0)
+                       .values_list('user_id', 'count'))
+        return statuses, in_work
+
+    def assertCountersConsistent(self):
+        counters = self.get_counters()
+        AdvertStatusCounter.objects.rebuild(self.category)
+        self.assertEqual(counters, self.get_counters())
+        return counters
+
+    def get_advert(self, index):
+        return Advert.objects.get(pk=self.adverts[index].pk)
+
+    def test_change_status(self):
+        self.get_advert(0).change_status(options.REJECTED, self.user)
+        statuses, in_work = self.assertCountersConsistent()
+        self.assertEqual(statuses, {options.NEW: 4, options.REJECTED: 1})
+
+        self.get_advert(0).change_status(options.NEW, self.user)
+        statuses, in_work = self.assertCountersConsistent()
+        self.assertEqual(statuses, {options.NEW: 5})
+
+    def test_change_status_to_in_work_and_back(self):
+        self.get_advert(0).change_status(options.IN_WORK, self.user)
+        statuses, in_work = self.assertCountersConsistent()
+        self.assertEqual(in_work, {self.user.pk: 1})
+
+        self.get_advert(0).change_status(options.USED, self.user)
+        statuses, in_work = self.assertCountersConsistent()
+        self.assertEqual(statuses, {options.NEW: 4, options.USED: 1})
+        self.assertEqual(in_work, {})
+
+    def test_add_and_remove_from_work(self):
+        self.get_advert(0).add_to_work(self.user)
+        self.get_advert(1).add_to_work(self.other_user)
+        statuses, in_work = self.assertCountersConsistent()
+        self.assertEqual(statuses, {options.NEW: 3})
+        self.assertEqual(in_work, {self.user.pk: 1, self.other_user.pk: 1})
+
+        self.get_advert(0).remove_from_work()
+        statuses, in_work = self.assertCountersConsistent()
+        self.assertEqual(statuses, {options.NEW: 4})
+        self.assertEqual(in_work, {self.other_user.pk: 1})
+
+    def test_work_complete(self):
+        self.get_advert(0).add_to_work(self.user)
+        self.get_advert(1).add_to_work(self.user)
+        self.get_advert(2).add_to_work(self.other_user)
+
+        request = RequestFactory().get('/', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        request.user = self.user
+        work_complete(request, self.category.alias)
+
+        statuses, in_work = self.assertCountersConsistent()
+        self.assertEqual(statuses, {options.NEW: 2, options.USED: 2})
+        self.assertEqual(in_work, {self.other_user.pk: 1})
+
+    def test_claim_new_adverts(self):
+        self.get_advert(0).add_to_work(self.other_user)
+        claimed = Advert.objects.claim_new_adverts(self.category, self.user, 3)
+
+        self.assertEqual(len(claimed), 3)
+        self.assertNotIn(self.adverts[0].pk, claimed)
+        statuses, in_work = self.assertCountersConsistent()
+        self.assertEqual(statuses, {options.NEW: 1})
+        self.assertEqual(in_work, {self.user.pk: 3, self.other_user.pk: 1})
+
+    def test_change_status_bulk(self):
+        self.get_advert(0).add_to_work(self.other_user)
+        advert_ids = [advert.pk for advert in self.adverts[:3]]
+
+        changed_ids, errors = Advert.objects.change_status_bulk(self.category, advert_ids, options.IN_WORK, self.user)
+        self.assertEqual(sorted(changed_ids), sorted(advert_ids[1:]))
+        self.assertEqual(list(errors), [advert_ids[0]])
+        statuses, in_work = self.assertCountersConsistent()
+        self.assertEqual(in_work, {self.user.pk: 2, self.other_user.pk: 1})
+
+        changed_ids, errors = Advert.objects.change_status_bulk(self.category, advert_ids[1:], options.REJECTED,
+                                                                self.user)
+        self.assertEqual(errors, {})
+        statuses, in_work = self.assertCountersConsistent()
+        self.assertEqual(statuses, {options.NEW: 2, options.REJECTED: 2})
+        self.assertEqual(in_work, {self.other_user.pk: 1})
@@ -1,36 +1,46 @@
+import json
 import os
+import time
 import uuid
 
+from django.conf import settings
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.core.urlresolvers import reverse
 from django.db import transaction
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse, Http404, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
-from django.template.loader import render_to_string
+from django.utils import timezone
 from django.utils.decorators import method_decorator
-from django.views.decorators.http import require_GET
+from django.views.decorators.http import require_GET, require_POST
 from django.views.generic import View
 from django.views.generic.base import TemplateResponseMixin
 
 from apps.adverts_v2.forms import CountForm
-from apps.adverts_v2.models import Category, Advert, AdvertPhoto, AdvertInWork
+from apps.adverts_v2.models import (Category, Advert, AdvertPhoto, AdvertInWork, AdvertStatusCounter,
+                                   AdvertChangeEvent)
 from libs.decorators import ajax_required
 from libs.utils import ChoicesHelper, import_by_name
 from . import options
+from .archives import StreamingArchiveBuilder, package_cache
+from .exports import AdvertExporter, CONTENT_TYPES
+from .fragments import render_advert_fragments
+from .instrumentation import instrument_view, render_to_string
+from .pagination import CursorPaginator, CursorPage
+from .photo_variations import PHOTO_VARIATIONS, render_variation
 
 
 def get_statuses_counts(request, category):
-    statuses_counts = {}
-    queryset = Advert.objects.get_category_queryset(category_alias=category.alias)
-    for val, _ in options.ADVERT_STATUSES:
-        if val == options.IN_WORK:
-            count = queryset.visible().filter(advertinwork__user=request.user).count()
-        else:
-            count = queryset.available().filter(status=val).count()
-        statuses_counts[val] = count
-    return statuses_counts
+    return AdvertStatusCounter.objects.get_counts(category, request.user)
 
 
+def render_advert_in_list(advert):
+    def load(advert_ids):
+        return advert.category.get_adverts_queryset().for_list().in_bulk(advert_ids)
+
+    return render_advert_fragments([advert], advert.status, load=load)[0]
+
+
+@method_decorator(instrument_view, name='dispatch')
 class AdvertsList(View, TemplateResponseMixin):
     template_name = 'adverts_v2/adverts.html'
     status = None
@@ -40,10 +50,26 @@ class AdvertsList(View, TemplateResponseMixin):
         self.category = get_object_or_404(Category, alias=kwargs.pop('category'))
         return super().dispatch(request, *args, **kwargs)
 
+    def get_search_query(self):
+        return self.request.GET.get('q', '').strip()
+
     def get_adverts_queryset(self):
-        return self.category.get_adverts_queryset().get_by_status(user=self.request.user, status=self.status).visible()
+        queryset = self.category.get_adverts_queryset().get_by_status(
+            user=self.request.user, status=self.status).visible().for_list()
+        search_query = self.get_search_query()
+        if search_query:
+            queryset = queryset.search(search_query)
+        return queryset
+
+    def is_cursor_pagination(self):
+        # результаты поиска упорядочены по релевантности, курсор по дате к ним не подходит
+        return 'cursor' in self.request.GET and not self.get_search_query()
 
     def get_paginated_adverts(self):
+        if self.is_cursor_pagination():
+            paginator = CursorPaginator(self.get_adverts_queryset(), options.ADVERTS_ON_PAGE)
+            return paginator.page(self.request.GET.get('cursor'))
+
         paginator = Paginator(self.get_adverts_queryset(), options.ADVERTS_ON_PAGE)
         paginator_page = self.request.GET.get('page', 1)
         try:
@@ -53,30 +79,46 @@ class AdvertsList(View, TemplateResponseMixin):
         except EmptyPage:
             return paginator.page(paginator.num_pages)
 
-    def render_adverts_list(self):
+    def render_adverts_list(self, paginated_adverts=None):
+        if paginated_adverts is None:
+            paginated_adverts = self.get_paginated_adverts()
         return render_to_string('adverts_v2/adverts-list.html', {
-            'paginated_adverts': self.get_paginated_adverts(),
+            'paginated_adverts': paginated_adverts,
+            'rendered_adverts': render_advert_fragments(paginated_adverts, self.status),
             'statuses': options.ADVERT_STATUSES_FULL,
             'status': self.status,
             'current_category': self.category,
+            'search_query': self.get_search_query(),
         })
 
     def get(self, request):
+        paginated_adverts = self.get_paginated_adverts()
         context = {
-            'rendered_adverts_list': self.render_adverts_list(),
+            'rendered_adverts_list': self.render_adverts_list(paginated_adverts),
         }
 
+        statuses_counts = None
+        if isinstance(paginated_adverts, CursorPage):
+            # точное количество не считаем, берём из счётчиков
+            statuses_counts = get_statuses_counts(request, self.category)
+            context.update(
+                next_cursor=paginated_adverts.next_cursor,
+                previous_cursor=paginated_adverts.previous_cursor,
+                total=statuses_counts.get(self.status, 0),
+            )
+
         if request.is_ajax():
             return JsonResponse(context)
 
-        def build_info(value, title, extra):
-            return value, title, extra, self.category.get_adverts_queryset().get_by_status(request.user, value).count()
-
+        if statuses_counts is None:
+            statuses_counts = get_statuses_counts(request, self.category)
         context.update(
             current_category=self.category,
             categories=Category.objects.all(),
             status=self.status,
-            statuses=[build_info(value, title, extra) for value, title, extra in options.ADVERT_STATUSES_FULL]
+            search_query=self.get_search_query(),
+            statuses=[(value, title, extra, statuses_counts.get(value, 0))
+                      for value, title, extra in options.ADVERT_STATUSES_FULL]
         )
         return self.render_to_response(context)
 
@@ -97,6 +139,7 @@ class AdvertsInWork(AdvertsList):
     status = options.IN_WORK
 
 
+@method_decorator(instrument_view, name='dispatch')
 class AdvertChange(View, TemplateResponseMixin):
     template_name = 'adverts_v2/advert-form.html'
 
@@ -129,11 +172,7 @@ class AdvertChange(View, TemplateResponseMixin):
 
             advert = form.save()
             return JsonResponse({
-                'updated_advert': render_to_string('adverts_v2/advert-in-list.html', {
-                    'advert': advert,
-                    'status': advert.status,
-                    'statuses': options.ADVERT_STATUSES_FULL,
-                })
+                'updated_advert': render_advert_in_list(advert)
             })
 
         form_errors = {}
@@ -145,6 +184,7 @@ class AdvertChange(View, TemplateResponseMixin):
         })
 
 
+@method_decorator(instrument_view, name='dispatch')
 class AdvertsBulkCreate(View, TemplateResponseMixin):
     template_name = 'adverts_v2/advert-bulk-create-form.html'
     category = None
@@ -174,13 +214,16 @@ class AdvertsBulkCreate(View, TemplateResponseMixin):
 
         form = self.form_class(request.POST)
         if form.is_valid():
-            for _ in range(0, form_count.cleaned_data['count']):
-                form._meta.model.objects.create(
+            model = form._meta.model
+            model.objects.bulk_create_adverts(
+                model(
                     donor=options.DUMMY,
                     donor_url=options.DUMMY_URL.format(uuid.uuid4()),
                     category=self.category,
                     **form.cleaned_data
                 )
+                for _ in range(0, form_count.cleaned_data['count'])
+            )
 
             return JsonResponse({
                     'link': reverse('adverts_v2:new-adverts', args=(self.category.alias, ))
@@ -194,18 +237,24 @@ class AdvertsBulkCreate(View, TemplateResponseMixin):
         })
 
 
+@instrument_view
 @require_GET
 @ajax_required
 def work_complete(request, category):
+    category = get_object_or_404(Category, alias=category)
     with transaction.atomic():
-        adverts = Advert.objects.get_category_queryset(category).filter(advertinwork__user=request.user)
-        adverts.update(status=options.USED)
+        adverts = Advert.objects.get_category_queryset(category=category).filter(advertinwork__user=request.user)
+        completed_ids = list(adverts.visible().values_list('id', flat=True))
+        adverts.update(status=options.USED, status_changed=timezone.now())
         AdvertInWork.objects.filter(advert__in=adverts).delete()
+        AdvertStatusCounter.objects.move(category.id, (options.IN_WORK, request.user.pk), (options.USED, None),
+                                         count=len(completed_ids), advert_ids=completed_ids, user_id=request.user.pk)
     return JsonResponse({
-        'redirect': reverse('adverts_v2:new-adverts', args=(category, ))
+        'redirect': reverse('adverts_v2:new-adverts', args=(category.alias, ))
     })
 
 
+@instrument_view
 @require_GET
 @ajax_required
 def add_to_work(request, advert_id):
@@ -216,12 +265,43 @@ def add_to_work(request, advert_id):
             'error': 'Не удалось добавить объявление в работу. {0}'.format(error)
         })
 
-    AdvertInWork.objects.get_or_create(advert=advert, user=request.user)
+    advert.add_to_work(request.user)
     return JsonResponse({
         'items': get_statuses_counts(request, advert.category)
     })
 
 
+@instrument_view
+@require_GET
+@ajax_required
+def claim_adverts(request, category):
+    category = get_object_or_404(Category, alias=category)
+    form_count = CountForm(request.GET)
+    if not form_count.is_valid():
+        form_errors = {}
+        for key, value in form_count.errors.items():
+            form_errors.setdefault(key, []).append(value)
+        return JsonResponse({
+            'form_errors': form_errors
+        })
+
+    count = min(form_count.cleaned_data['count'], options.ADVERTS_ON_PAGE)
+    advert_ids = Advert.objects.claim_new_adverts(category, request.user, count)
+    paginated_adverts = CursorPage(list(category.get_adverts_queryset().filter(pk__in=advert_ids).for_list()))
+    return JsonResponse({
+        'claimed': len(advert_ids),
+        'rendered_adverts_list': render_to_string('adverts_v2/adverts-list.html', {
+            'paginated_adverts': paginated_adverts,
+            'rendered_adverts': render_advert_fragments(paginated_adverts, options.IN_WORK),
+            'statuses': options.ADVERT_STATUSES_FULL,
+            'status': options.IN_WORK,
+            'current_category': category,
+        }),
+        'items': get_statuses_counts(request, category),
+    })
+
+
+@instrument_view
 @require_GET
 @ajax_required
 def change_photo_status(request, photo_id):
@@ -241,6 +321,7 @@ def change_photo_status(request, photo_id):
     return JsonResponse({})
 
 
+@instrument_view
 @require_GET
 @ajax_required
 def change_photo_main(request, photo_id):
@@ -269,6 +350,19 @@ def change_photo_main(request, photo_id):
     return JsonResponse({})
 
 
+@instrument_view
+@require_GET
+def get_photo_variation(request, photo_id, variation):
+    if variation not in PHOTO_VARIATIONS:
+        raise Http404
+
+    image = get_object_or_404(AdvertPhoto, id=photo_id)
+    storage = image.image.storage
+    variation_name = render_variation(image.image.name, variation, storage)
+    return HttpResponseRedirect(storage.url(variation_name))
+
+
+@instrument_view
 @require_GET
 @ajax_required
 def refresh_description(request, advert_id):
@@ -280,10 +374,11 @@ def refresh_description(request, advert_id):
         })
 
     advert.generate_texts(fields=('description', ))
-    advert.save(update_fields=('description', ))
+    advert.save(update_fields=('description', 'updated'))
     return JsonResponse({'text': advert.description})
 
 
+@instrument_view
 @require_GET
 @ajax_required
 def set_original_description(request, advert_id):
@@ -301,17 +396,14 @@ def set_original_description(request, advert_id):
         })
 
     setattr(advert, target_field, getattr(advert, '{}_original'.format(target_field)))
-    advert.save(update_fields=(target_field, ))
+    advert.save(update_fields=(target_field, 'updated'))
 
     return JsonResponse({
-        'updated_advert': render_to_string('adverts_v2/advert-in-list.html', {
-            'advert': advert,
-            'status': advert.status,
-            'statuses': options.ADVERT_STATUSES_FULL,
-        })
+        'updated_advert': render_advert_in_list(advert)
     })
 
 
+@instrument_view
 @require_GET
 @ajax_required
 def change_advert_status(request, advert_id):
@@ -335,19 +427,42 @@ def change_advert_status(request, advert_id):
             'error': 'Не удалось изменить статус объявления. Получено некорректное значение "{0}"'.format(status)
         })
 
-    if advert.status != status:
-        advert.status = status
-        advert.save(update_fields=('status', ))
-        if status == options.IN_WORK:
-            AdvertInWork.objects.get_or_create(advert=advert, user=request.user)
-        else:
-            AdvertInWork.objects.filter(advert=advert).delete()
+    advert.change_status(status, request.user)
 
     return JsonResponse({
         'items': get_statuses_counts(request, advert.category)
     })
 
 
+@instrument_view
+@require_POST
+@ajax_required
+def change_adverts_status(request, category):
+    category = get_object_or_404(Category, alias=category)
+
+    status = request.POST.get('status')
+    try:
+        status = int(status)
+        advert_ids = [int(advert_id) for advert_id in request.POST.getlist('ids')]
+    except (TypeError, ValueError):
+        return JsonResponse({
+            'error': 'Не удалось изменить статус объявлений. Получены некорректные данные'
+        })
+
+    if status not in [value for value, title in options.ADVERT_STATUSES]:
+        return JsonResponse({
+            'error': 'Не удалось изменить статус объявлений. Получено некорректное значение "{0}"'.format(status)
+        })
+
+    changed_ids, errors = Advert.objects.change_status_bulk(category, advert_ids, status, request.user)
+    return JsonResponse({
+        'changed': changed_ids,
+        'errors': errors,
+        'items': get_statuses_counts(request, category),
+    })
+
+
+@instrument_view
 def get_package(request, category):
     category = get_object_or_404(Category, alias=category)
     adverts_in_work = category.get_adverts_queryset().filter(advertinwork__user=request.user)
@@ -358,6 +473,12 @@ def get_package(request, category):
     if builder_class is None:
         return HttpResponse('Ошибка: не удалось найти сборщик архива.')
 
+    if issubclass(builder_class, StreamingArchiveBuilder):
+        builder = builder_class(adverts_in_work.for_list())
+        response = StreamingHttpResponse(builder.stream(), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename={0}'.format(builder.get_archive_name())
+        return response
+
     with builder_class(adverts_in_work) as builder:
         response = HttpResponse(content_type='application/zip')
         response['Content-Disposition'] = 'attachment; filename={0}'.format(os.path.basename(builder.archive_path))
@@ -366,3 +487,108 @@ def get_package(request, category):
             response.write(archive_file.read())
 
     return response
+
+
+@instrument_view
+@require_GET
+def get_package_cache_stats(request):
+    return JsonResponse(package_cache.get_stats())
+
+
+@instrument_view
+@require_GET
+def export_adverts(request, category):
+    category = get_object_or_404(Category, alias=category)
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in CONTENT_TYPES:
+        raise Http404
+
+    try:
+        statuses = [int(status) for status in request.GET.getlist('status')]
+    except ValueError:
+        raise Http404
+
+    exporter = AdvertExporter(category, statuses)
+    response = StreamingHttpResponse(exporter.stream(export_format), content_type=CONTENT_TYPES[export_format])
+    response['Content-Disposition'] = 'attachment; filename={0}'.format(exporter.get_file_name(export_format))
+    return response
+
+
+# ожидание занимает синхронный воркер целиком, поэтому по умолчанию оно короткое. Длинные
+# значения ставить только если get_changes и stream_changes обслуживают асинхронные воркеры
+# (gunicorn -k gevent или отдельный пул), иначе операторы быстро займут весь пул.
+CHANGES_POLL_TIMEOUT = getattr(settings, 'ADVERTS_CHANGES_POLL_TIMEOUT', 5)
+CHANGES_STREAM_DURATION = getattr(settings, 'ADVERTS_CHANGES_STREAM_DURATION', 15)
+
+
+def get_since_version(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+@instrument_view
+@require_GET
+def get_changes(request, category):
+    category = get_object_or_404(Category, alias=category)
+    since = get_since_version(request.GET.get('since'))
+    if since is None:
+        # первый запрос: текущая версия и счётчики, дальше клиент ждёт только изменения
+        return JsonResponse({
+            'version': AdvertChangeEvent.objects.get_version(category.id),
+            'items': get_statuses_counts(request, category),
+        })
+
+    events, resync = AdvertChangeEvent.objects.wait(category.id, since, CHANGES_POLL_TIMEOUT)
+    if events:
+        since = events[-1].version
+    elif resync:
+        since = AdvertChangeEvent.objects.get_version(category.id)
+    context = {
+        'version': since,
+        'events': [event.as_dict() for event in events],
+        'resync': resync,
+    }
+    if resync:
+        # часть изменений потеряна, дельтам верить нельзя - отдаём счётчики целиком
+        context['items'] = get_statuses_counts(request, category)
+    return JsonResponse(context)
+
+
+def iter_change_stream(category_id, since, get_counts):
+    deadline = time.monotonic() + CHANGES_STREAM_DURATION
+    # поток короткий, EventSource переподключится сам и продолжит с Last-Event-ID
+    yield 'retry: 1000\n\n'
+    while time.monotonic() < deadline:
+        events, resync = AdvertChangeEvent.objects.wait(
+            category_id, since, min(CHANGES_POLL_TIMEOUT, max(deadline - time.monotonic(), 0)))
+        if not events and not resync:
+            yield ': keep-alive\n\n'
+            continue
+        for event in events:
+            yield 'id: {0}\nevent: change\ndata: {1}\n\n'.format(event.version, json.dumps(event.as_dict()))
+        if events:
+            since = events[-1].version
+        elif resync:
+            since = AdvertChangeEvent.objects.get_version(category_id)
+        if resync:
+            yield 'id: {0}\nevent: resync\ndata: {1}\n\n'.format(since, json.dumps({'items': get_counts()}))
+
+
+@instrument_view
+@require_GET
+def stream_changes(request, category):
+    category = get_object_or_404(Category, alias=category)
+    # EventSource при переподключении присылает последний полученный id сам
+    since = get_since_version(request.META.get('HTTP_LAST_EVENT_ID', request.GET.get('since')))
+    if since is None:
+        since = AdvertChangeEvent.objects.get_version(category.id)
+
+    response = StreamingHttpResponse(
+        iter_change_stream(category.id, since, lambda: get_statuses_counts(request, category)),
+        content_type='text/event-stream',
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response